@@ -16,12 +16,14 @@ from functools import wraps
 
 from pptable import pptable
 import fabric.decorators
-from fabric.api import abort
+from fabric.api import abort, execute, parallel, serial
 
 from cotton.provider.driver import provider_class
+from cotton.provider.inventory import InventoryCache
 from cotton.common import *
 from cotton.colors import *
-from cotton.config import get_provider_zone_config
+from cotton.config import get_provider_zone_config, thaw
+from cotton.ssh_utils import ssh_control_dir
 
 
 def load_provider(func):
@@ -46,6 +48,7 @@ def load_provider(func):
 def get_provider_connection():
     """
     returns initialized provider object and caches it in env.provider
+    provider is wrapped in InventoryCache so filter() and status() results are reused
     """
     zone_config = get_provider_zone_config()
 
@@ -55,7 +58,7 @@ def get_provider_connection():
 
     if not 'provider' in env or not env.provider:
         p_class = provider_class(zone_config['driver'])
-        env.provider = p_class(**zone_config)
+        env.provider = InventoryCache(p_class(**zone_config), zone=env.provider_zone, **zone_config)
     return env.provider
 
 
@@ -69,6 +72,9 @@ def vm_task(func):
     Decorator loads provider and configures current host based on env.vm_name
     unless env.vm is already set
 
+    If hosts were selected with `select_hosts` task then wrapped task is executed
+    on every selected host (env.vm_pool_size at a time) and summary is printed at the end.
+
     updated variables:
     env.provider
     env.vm
@@ -81,6 +87,9 @@ def vm_task(func):
     @wraps(func)
     def inner(*args, **kwargs):
 
+        if ('vm' not in env or not env.vm) and 'vm_selector' in env and env.vm_selector:
+            return _execute_on_selected_hosts(func, args, kwargs)
+
         if 'vm' not in env or not env.vm:
             assert env.vm_name
             configure_fabric_for_host(env.vm_name)
@@ -96,11 +105,107 @@ def vm_task(func):
     return fabric.decorators.task(inner)
 
 
+def _select_vms(selector):
+    """
+    returns VMs matching selector, selector['name'] may also be a list of names
+    """
+    names = selector.get('name', None)
+    if not isinstance(names, list):
+        return env.provider.filter(**selector)
+    vms = []
+    for name in names:
+        vms.extend(env.provider.filter(**dict(selector, name=name)))
+    return vms
+
+
+def _execute_on_selected_hosts(func, args, kwargs):
+    """
+    runs func on every vm matching env.vm_selector, aborts if it failed on any of them
+    """
+    get_provider_connection()
+    vms = _select_vms(env.vm_selector)
+    if not vms:
+        abort(red("No VM matches {}".format(env.vm_selector)))
+
+    selected = {}
+    for vm in vms:
+        selected[env.provider.host_string(vm)] = (env.provider.server_name(vm), vm)
+
+    def run_on_host():
+        vm_name, vm = selected[env.host_string]
+        configure_fabric_for_vm(vm, vm_name)
+        print(green("[{}:{}]".format(func.__name__, vm_name)))
+        start_time = time.time()
+        try:
+            ret = func(*args, **kwargs)
+            failure = None
+        except SystemExit:
+            # abort() - don't let one host stop the others
+            ret = None
+            failure = 'aborted'
+        except Exception as e:
+            ret = None
+            failure = "{}".format(e) or e.__class__.__name__
+        return {'name': vm_name, 'result': ret, 'failure': failure, 'duration': time.time() - start_time}
+
+    run_on_host.__name__ = func.__name__
+
+    pool_size = int(env.vm_pool_size) if 'vm_pool_size' in env and env.vm_pool_size else 1
+    if pool_size > 1:
+        run_on_host = parallel(pool_size=pool_size)(run_on_host)
+        # before forking, so all workers share one connection per host and gateway
+        ssh_control_dir()
+    else:
+        run_on_host = serial(run_on_host)
+
+    start_time = time.time()
+    try:
+        results = execute(run_on_host, hosts=sorted(selected, key=lambda host: selected[host][0]))
+    finally:
+        # serial execution leaves last host configured, following tasks have to fan out again
+        env.vm = None
+
+    summary = []
+    failed = 0
+    for host_string in sorted(results, key=lambda host: selected[host][0]):
+        result = results[host_string]
+        if result['failure'] is not None:
+            failed += 1
+        summary.append({
+            'name': result['name'],
+            'host': host_string,
+            'status': 'failed: {}'.format(result['failure']) if result['failure'] is not None else 'ok',
+            'duration': "{:.2f}s".format(result['duration']),
+        })
+    pptable(summary, headers=['name', 'host', 'status', 'duration'])
+
+    color = red if failed else green
+    print(color("[{}] {} succeeded, {} failed on {} hosts in: {:.2f}s".format(
+        func.__name__, len(results) - failed, failed, len(results), time.time() - start_time)))
+    if failed:
+        abort(red("[{}] failed on {} hosts".format(func.__name__, failed)))
+    return dict((result['name'], result['result']) for result in results.itervalues())
+
+
 def configure_fabric_for_host(name):
     """
     loads provider and configures current host based on name
 
-    if zone_config['gateway'] than it will be configured
+    see configure_fabric_for_vm
+    """
+    get_provider_connection()
+    vms = env.provider.filter(name=name)
+    if not vms:
+        abort(red("VM name='{}' not found".format(name)))
+    # will pick first vm from list in case more are available
+    configure_fabric_for_vm(vms[0], name)
+
+
+def configure_fabric_for_vm(vm, name):
+    """
+    configures current host based on server object returned by provider
+
+    if zone_config['gateway'] than it will be configured (zone_config['gateway_transport'] selects how, see ssh_utils.ssh_proxy_opts)
     if zone_config['ssh_key'] is supplied then we use it
     if we are in provisioning mode than zone_config['provisioning_ssh_key'] & zone_config['provisioning_user'] & zone_config['provisioning_password'] is used
 
@@ -113,12 +218,7 @@ def configure_fabric_for_host(name):
     env.key_filename
     env.user if in provisioning mode
     """
-    get_provider_connection()
-    vms = env.provider.filter(name=name)
-    if not vms:
-        abort(red("VM name='{}' not found".format(name)))
-    # will pick first vm from list in case more are available
-    env.vm = vms[0]
+    env.vm = vm
 
     env.vm_name = name
 
@@ -151,6 +251,8 @@ def configure_fabric_for_host(name):
             env.gateway = '{}@{}'.format(env.gateway_user, zone_config['gateway'])
         else:
             env.gateway = '{}@{}'.format(env.user, zone_config['gateway'])
+        if 'gateway_transport' in zone_config and not ('gateway_transport' in env and env.gateway_transport):
+            env.gateway_transport = zone_config['gateway_transport']
 
 
 def dict_stringize_keys(data):
@@ -168,14 +270,13 @@ def dict_stringize_keys(data):
     return res
 
 
-@task
-@load_provider
-def create(name=None):
-    from cotton.fabextras import wait_for_shell
-
+def _get_vm_spec():
+    """
+    returns vm-defaults of current provider zone extended by env/project tags
+    """
     zone_config = get_provider_zone_config()
-    vm_spec = zone_config.get('vm-defaults', {})
-    vm_spec['name'] = name
+    # zone config is shared and read only
+    vm_spec = thaw(zone_config.get('vm-defaults', {}))
 
     try:
         vm_spec['tags']
@@ -186,6 +287,16 @@ def create(name=None):
         vm_spec['tags']['env'] = env.environment
     if 'project' in env:
         vm_spec['tags']['project'] = env.project
+    return vm_spec
+
+
+@task
+@load_provider
+def create(name=None):
+    from cotton.fabextras import wait_for_shell
+
+    vm_spec = _get_vm_spec()
+    vm_spec['name'] = name
 
     try:
         vm = env.provider.create(**vm_spec)
@@ -196,6 +307,56 @@ def create(name=None):
     return vm
 
 
+@task
+@load_provider
+def create_many(names, pool_size=10):
+    """
+    creates several VMs at once, i.e.: create_many:names=web-01;web-02;web-03
+    VMs are launched together and shells are awaited in parallel (pool_size hosts at a time)
+    following @vm_task tasks are executed on all created VMs (as if selected with select_hosts)
+    """
+    from cotton.fabextras import wait_for_shell
+
+    names = names.split(';')
+    vm_spec = _get_vm_spec()
+
+    start_time = time.time()
+    try:
+        vms = env.provider.create_many(names, **vm_spec)
+    except ValueError as e:
+        abort(red(e))
+    launch_time = time.time() - start_time
+
+    # ssh key, user and gateway are the same for all hosts in the zone
+    configure_fabric_for_host(names[0])
+    host_strings = [env.provider.host_string(vm) for vm in vms]
+
+    @parallel(pool_size=int(pool_size))
+    def timed_wait_for_shell():
+        shell_start_time = time.time()
+        wait_for_shell()
+        return time.time() - shell_start_time
+
+    shell_times = execute(timed_wait_for_shell, hosts=host_strings)
+
+    timings = []
+    for name, host_string in zip(names, host_strings):
+        timings.append({
+            'name': name,
+            'host': host_string,
+            'launch': "{:.2f}s".format(launch_time),
+            'shell': "{:.2f}s".format(shell_times[host_string]),
+        })
+    pptable(timings, headers=['name', 'host', 'launch', 'shell'])
+
+    # configure_fabric_for_host left the first VM configured
+    env.vm = None
+    env.vm_name = None
+    env.vm_selector = {'name': names}
+    env.vm_pool_size = int(pool_size)
+    return vms
+
+
 @vm_task
 def destroy():
     env.provider.terminate(env.vm)
@@ -203,15 +364,53 @@ def destroy():
 
 @vm_task
 def info():
-    pprint.pprint(env.provider.info(env.vm))
+    pprint.pprint(dict(env.provider.info(env.vm)))
 
 
 @task
 @load_provider
-def status():
-    #TODO: format output
-    statuses = env.provider.status()
-    pptable(statuses)
+def status(stream=False):
+    """
+    lists servers in provider zone, status:stream=1 prints rows as soon as provider returns them
+    """
+    if not is_true(stream):
+        #TODO: format output
+        statuses = env.provider.status()
+        pptable(statuses)
+        return
+
+    headers = None
+    for row in env.provider.iter_status():
+        if headers is None:
+            headers = sorted(row.keys())
+            print("\t".join(headers))
+        print("\t".join("{}".format(row.get(header, '')) for header in headers))
+
+
+@task
+@load_provider
+def select_hosts(name=None, salt_role=None, tag=None, pool_size=1):
+    """
+    selects hosts for following @vm_task tasks, i.e.: select_hosts:name=web-*,pool_size=5 uptime
+    name: glob matched against VM names
+    salt_role: salt role as reported by info()['roles']
+    tag: key:value pair (where provider supports tags)
+    pool_size: number of hosts tasks are executed on in parallel
+    """
+    selector = {}
+    if name is not None:
+        selector['name'] = name
+    if salt_role is not None:
+        selector['role'] = salt_role
+    if tag is not None:
+        key, _, value = tag.partition(':')
+        selector['tags'] = {key: value}
+    if not selector:
+        abort(red("Specify at least one of: name, salt_role, tag"))
+
+    env.vm = None
+    env.vm_selector = selector
+    env.vm_pool_size = int(pool_size)
 
 
 @task
@@ -0,0 +1,72 @@
+"""
+persistent on-disk cache shared by cotton modules
+
+~/.cache/cotton/ / ${COTTON_CACHE_DIR}
+|-- config/<key>.pickle
+`-- ...
+
+Cached data may contain credentials (i.e. merged ~/.cotton.yaml) so
+directories are created with 0700 and files are written with 0600.
+
+Caching can be switched off by setting COTTON_CACHE_DIR to an empty string.
+"""
+import os
+import errno
+import hashlib
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def cache_enabled():
+    return os.environ.get('COTTON_CACHE_DIR', None) != ''
+
+
+def cache_dir(*parts):
+    """
+    returns (and creates) cache directory for given sub path
+    """
+    base_dir = os.environ.get('COTTON_CACHE_DIR', None) or '~/.cache/cotton'
+    path = os.path.join(os.path.expanduser(base_dir), *parts)
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def cache_key(*parts):
+    """
+    returns stable filename friendly hash of arbitrary (repr-able) data
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def load(path):
+    """
+    returns unpickled content of path or None if it is missing or unreadable
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+        return None
+
+
+def dump(path, data):
+    """
+    atomically replaces path with pickled data
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
@@ -1,6 +1,8 @@
 from __future__ import print_function
 from fabric.api import task, env
 
+from cotton.ssh_utils import ssh_control_dir
+
 
 if 'provisioning' not in env:
     env.provisioning = False
@@ -25,6 +27,13 @@ if 'instances' not in env:
 #}
 
 
+def is_true(value):
+    """
+    parses boolean task argument - fab passes task arguments as strings
+    """
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
 @task
 def provisioning():
     """
@@ -52,6 +61,18 @@ def insecure():
     env.disable_known_hosts = True
 
 
+@task
+def multiplex(persist=600):
+    """
+    share one ssh connection per host (and gateway) between ssh, ssh_forward and rsync calls
+    masters are closed when fab exits
+    manages: env.ssh_multiplex, env.ssh_control_persist
+    """
+    env.ssh_multiplex = True
+    env.ssh_control_persist = persist
+    ssh_control_dir()
+
+
 @task
 def force():
     """
@@ -36,60 +36,109 @@ env.project can be a path and in such case cotton.yaml will be ingested on every
 
 """
 from __future__ import print_function
-import yaml
 import os
-import copy
 
 from fabric.api import env
 from cotton.colors import *
+from cotton import cache
+from cotton import yaml_utils
 
 
-def dict_deepmerge(source, target):
+class FrozenDict(dict):
+    """
+    read only dictionary as returned by freeze()
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("'{}' object does not support item assignment".format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+
+def freeze(data):
+    """
+    returns read only version of data: dicts become FrozenDict and lists become tuples
+    already frozen subtrees are shared as is
+    """
+    if isinstance(data, FrozenDict):
+        return data
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k, v in data.iteritems())
+    if isinstance(data, list):
+        return tuple(freeze(v) for v in data)
+    return data
+
+
+def thaw(data):
+    """
+    returns mutable deep copy of (possibly frozen) data
+    """
+    if isinstance(data, dict):
+        return dict((k, thaw(v)) for k, v in data.iteritems())
+    if isinstance(data, (list, tuple)):
+        return [thaw(v) for v in data]
+    return data
+
+
+def dict_deepmerge(source, target, freeze_result=False):
     """
     deep merges two dictionaries and returns merged value
     'source' is merged on top of 'target'
     think:
      - python inheritance pattern
      - final dictionary simulates left hand search
+
+    neither 'source' nor 'target' is modified and nothing is copied:
+    subtrees that are not overridden are shared between arguments and result,
+    only dictionaries present in both get materialised.
+    Use freeze_result=True to make sure that callers can't alter shared state.
     """
     assert isinstance(source, dict)
     assert isinstance(target, dict)
 
     if not target:
-        return source.copy()
-
-    merged = copy.deepcopy(target)
-
-    for k, v in source.iteritems():
-        if k in merged and isinstance(v, dict) and isinstance(merged[k], dict):
-            merged[k] = dict_deepmerge(v, merged[k])
-        else:
-            merged[k] = copy.deepcopy(v)
-
+        merged = dict(source)
+    elif not source:
+        merged = dict(target)
+    else:
+        merged = dict(target)
+        for k, v in source.iteritems():
+            if k in merged and isinstance(v, dict) and isinstance(merged[k], dict):
+                merged[k] = dict_deepmerge(v, merged[k])
+            else:
+                merged[k] = v
+
+    if freeze_result:
+        return freeze(merged)
     return merged
 
 
-def _load_config_file(path):
+def _config_file_location(path):
     fab_location = os.path.dirname(env.real_fabfile)
-    config_location = os.path.abspath(os.path.join(fab_location, path))
+    return os.path.abspath(os.path.join(fab_location, path))
 
-    with open(config_location) as f:
-        return yaml.load(f)
 
+def _load_config_file(path):
+    return yaml_utils.load_file(_config_file_location(path))
 
-def get_config():
+
+def _get_config_files():
     """
-    merges user config with global config and project config
+    returns list of candidate config files
+    last file in the list is the most important
     """
-    if '__config' in env and env.__config:
-        return env.__config
-    print("Merging config files:")
     # TODO: allow in COTTON_CONFIG to specify location of config repo
     # I.e.: cotton.config = ../config
 
     # If a preferred location is specified in the hash the old path is deprecated and a warning
     # should be shown
-    # Last file in the list is the most important
 
     config_base_dir = '../config'
     if 'project' in env and env.project:
@@ -114,7 +163,7 @@ def get_config():
                              'preferred': os.path.join(path, 'cotton.yaml')})
         config_files.append({'path': os.path.join(path, 'cotton.yaml')})
 
-    if 'provider_zone' in env and 'vagrant' in env.provider_zone:
+    if 'provider_zone' in env and env.provider_zone and 'vagrant' in env.provider_zone:
         config_files.append({'path': 'vagrant/cotton.yaml',
                              'preferred': 'cotton.yaml'})
 
@@ -126,16 +175,87 @@ def get_config():
                              'preferred': '~/.cotton.yaml'})
         config_files.append({'path': '~/.cotton.yaml'})
 
-    merged_config = {}
+    return config_files
+
+
+def _config_files_signature(config_files):
+    """
+    returns list of (path, exists, (mtime, size, inode)) for every candidate file
+    any change of this signature invalidates cached merged config
+    """
+    signature = []
+    for config_file in config_files:
+        config_filename = os.path.expanduser(config_file.get('path'))
+        try:
+            st = os.stat(_config_file_location(config_filename))
+            file_stat = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            file_stat = None
+        signature.append((config_filename, os.path.exists(config_filename), file_stat))
+    return signature
+
+
+def _get_config_cache_file(config_files):
+    """
+    returns location of cached merged config for this list of candidate files
+    or None if config caching is disabled (env.config_cache = False)
+    """
+    if not cache.cache_enabled():
+        return None
+    if 'config_cache' in env and not env.config_cache:
+        return None
+    key = cache.cache_key(os.path.dirname(env.real_fabfile), [config_file['path'] for config_file in config_files])
+    return os.path.join(cache.cache_dir('config'), '{}.pickle'.format(key))
+
+
+def _save_config_snapshot(snapshot):
+    cache_file = snapshot.get('cache_file')
+    if not cache_file:
+        return
+    try:
+        cache.dump(cache_file, dict((k, v) for k, v in snapshot.iteritems() if k != 'cache_file'))
+    except (IOError, OSError) as e:
+        print(yellow("Warning - unable to cache merged config: {}".format(e)))
+
+
+def _get_config_snapshot():
+    """
+    returns dictionary with parsed config files ('layers', least important first)
+    and once computed also merged config ('config')
+
+    snapshot is persisted in ~/.cache/cotton/config and reused as long as
+    none of the candidate files has been added, removed or modified
+    """
+    if '__config_snapshot' in env and env.__config_snapshot:
+        return env.__config_snapshot
+    print("Merging config files:")
+
+    config_files = _get_config_files()
+    signature = _config_files_signature(config_files)
+    cache_file = _get_config_cache_file(config_files)
+
+    if cache_file:
+        cached = cache.load(cache_file)
+        if cached and cached.get('signature') == signature and 'layers' in cached:
+            for config_filename in cached['loaded']:
+                print(green("Loaded:  {} (cached)".format(config_filename)))
+            cached['cache_file'] = cache_file
+            env.__config_snapshot = cached
+            return cached
+
+    layers = []
+    loaded = []
     for config_file in config_files:
         config_filename = os.path.expanduser(config_file.get('path'))
         if os.path.exists(config_filename):
             try:
                 loaded_config = _load_config_file(config_filename)
+                assert isinstance(loaded_config, dict)
                 print(green("Loaded:  {}".format(config_filename)))
                 if config_file.get('preferred'):
                     print(red("Deprecated location for {} - Please use {}".format(config_filename, config_file.get('preferred'))))
-                merged_config = dict_deepmerge(loaded_config, merged_config)
+                layers.append(loaded_config)
+                loaded.append(config_filename)
             except Exception as e:
                 if 'preferred' not in config_file:
                     print(yellow("Warning - error loading config: {}".format(config_filename)))
@@ -145,26 +265,94 @@ def get_config():
             if 'preferred' not in config_file:
                 print("Skipped: {}".format(config_filename))
 
-    env.__config = merged_config
-    return merged_config
+    snapshot = {'signature': signature, 'loaded': loaded, 'layers': layers, 'cache_file': cache_file}
+    _save_config_snapshot(snapshot)
+
+    env.__config_snapshot = snapshot
+    return snapshot
+
+
+def get_config():
+    """
+    merges user config with global config and project config
+    """
+    if '__config' in env and env.__config:
+        return env.__config
+
+    snapshot = _get_config_snapshot()
+    if 'config' not in snapshot:
+        merged_config = {}
+        for layer in snapshot['layers']:
+            merged_config = dict_deepmerge(layer, merged_config)
+        snapshot['config'] = merged_config
+        # merged config shares subtrees with layers so it is cheap to persist
+        _save_config_snapshot(snapshot)
+
+    env.__config = snapshot['config']
+    return env.__config
+
+
+def _resolve_zone_name(layers, zone):
+    """
+    returns zone if any layer defines it, otherwise name of the default zone
+    """
+    default = None
+    for layer in layers:
+        provider_zones = layer.get('provider_zones', None)
+        if isinstance(provider_zones, dict):
+            if zone in provider_zones:
+                return zone
+            default = provider_zones.get('default', default)
+    if default is None:
+        raise RuntimeError("Provider zone %s is not defined and there is no default zone!" % zone)
+    return default
+
+
+def _merge_zone(layers, zone):
+    """
+    merges provider_zones.<zone> subtree across layers without touching other zones
+    """
+    cfg = None
+    for layer in layers:
+        provider_zones = layer.get('provider_zones', None)
+        if not isinstance(provider_zones, dict):
+            if 'provider_zones' in layer:
+                # a non dictionary value overrides all zones
+                cfg = None
+            continue
+        if zone not in provider_zones:
+            continue
+        value = provider_zones[zone]
+        if isinstance(value, dict) and isinstance(cfg, dict):
+            cfg = dict_deepmerge(value, cfg)
+        else:
+            cfg = value
+    return cfg
 
 
-def get_provider_zone_config():
+def get_provider_zone_config(zone=None):
     """
     return get_config()['provider_zones'][env.provider_zone]
     if key does not exist than falls back to default zone
-    """
-    config = get_config()
 
-    if env.provider_zone in config['provider_zones']:
+    only provider_zones.<zone> gets merged across config files, result is
+    read only (use cotton.config.thaw for a mutable copy) and cached per zone
+    """
+    if zone is None:
         zone = env.provider_zone
-    else:
-        zone = config['provider_zones']['default']
 
+    if '__zone_configs' not in env or env.__zone_configs is None:
+        env.__zone_configs = {}
+    if zone in env.__zone_configs:
+        return env.__zone_configs[zone]
 
-    cfg = config['provider_zones'][zone]
-    if 'driver' not in cfg:
-        raise RuntimeError("Provider zone %s is missing the 'driver' option!" % zone)
+    layers = _get_config_snapshot()['layers']
+    zone_name = _resolve_zone_name(layers, zone)
 
-    return cfg
+    cfg = _merge_zone(layers, zone_name)
+    if not isinstance(cfg, dict) or 'driver' not in cfg:
+        raise RuntimeError("Provider zone %s is missing the 'driver' option!" % zone_name)
 
+    cfg = freeze(cfg)
+    env.__zone_configs[zone] = cfg
+    return cfg
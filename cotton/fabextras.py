@@ -7,7 +7,7 @@ import getpass
 from fabric.api import settings, sudo, run, hide, local, task, parallel, env
 from fabric.exceptions import NetworkError
 
-from cotton.ssh_utils import rsync_project
+from cotton.ssh_utils import rsync_project, ssh_control_opts, ssh_proxy_opts
 from cotton.api import vm_task
 
 # thanks to
@@ -66,11 +66,10 @@ def ssh_forward(lport, rport):
     """
     open ssh session and tunnel port ssh_forward:local_port,remote_port
     """
-    #TODO: enable it to work with env.gateway
     if 'key_filename' in env and env.key_filename:
-        local('ssh -o "ServerAliveInterval 30" -A -i {key} -p {port} -L {lport}:127.0.0.1:{rport} {user}@{host}'.format(key=env.key_filename, user=env.user, host=env.host, port=env.port, lport=lport, rport=rport))
+        local('ssh -o "ServerAliveInterval 30" -A -i {key} {control_opts} -p {port} -L {lport}:127.0.0.1:{rport} {user}@{host} {proxy_opts}'.format(key=env.key_filename, control_opts=ssh_control_opts(), user=env.user, host=env.host, port=env.port, lport=lport, rport=rport, proxy_opts=ssh_proxy_opts(env.user, "-i {}".format(env.key_filename))))
     else:
-        local('ssh -o "ServerAliveInterval 30" -A -p {port} -L {lport}:127.0.0.1:{rport} {user}@{host}'.format(key=env.key_filename, user=env.user, host=env.host, port=env.port, lport=lport, rport=rport))
+        local('ssh -o "ServerAliveInterval 30" -A {control_opts} -p {port} -L {lport}:127.0.0.1:{rport} {user}@{host} {proxy_opts}'.format(key=env.key_filename, control_opts=ssh_control_opts(), user=env.user, host=env.host, port=env.port, lport=lport, rport=rport, proxy_opts=ssh_proxy_opts(env.user)))
 
 
 def is_not_empty(path, use_sudo=False, verbose=False):
@@ -119,25 +118,38 @@ def smart_rsync_project(*args, **kwargs):
     rsync_project wrapper that is aware of insecure fab argument and can chown the target directory
 
     :param for_user: optional, chowns the directory to this user at the end
+    :param chown_mode: optional, how for_user ownership is applied (defaults to env.rsync_chown_mode):
+        'recursive' (default) - chown -R the whole directory to env.user before and back to for_user after rsync
+        'rsync' - remote rsync runs via sudo with --chown so only transferred files are touched
+                  (needs rsync >= 3.1 and passwordless sudo for rsync on remote host)
     """
     if 'for_user' in kwargs:
         for_user = kwargs.pop('for_user')
     else:
         for_user = None
+    default_chown_mode = env.rsync_chown_mode if 'rsync_chown_mode' in env and env.rsync_chown_mode else 'recursive'
+    chown_mode = kwargs.pop('chown_mode', default_chown_mode)
+    if chown_mode not in ('recursive', 'rsync'):
+        raise ValueError("Unknown chown_mode '{}' - use one of: recursive, rsync".format(chown_mode))
     directory = args[0]
   
     if env.disable_known_hosts:
         kwargs['ssh_opts'] = kwargs.get('ssh_opts', '') + " -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
 
+    if for_user and chown_mode == 'rsync':
+        kwargs['extra_opts'] = "{} --rsync-path='sudo rsync' -o --chown={}".format(kwargs.get('extra_opts', ''), for_user)
+        return rsync_project(*args, **kwargs)
+
     if for_user:
         with settings(warn_only=True):
             sudo("find {} -type d -exec chmod u+rwx {{}} +".format(directory))
             sudo("chown -R {} {}".format(env.user, directory))
 
-    rsync_project(*args, **kwargs)
+    ret = rsync_project(*args, **kwargs)
 
     if for_user:
         sudo("chown -R {} {}".format(for_user, directory))
+    return ret
 
 
 def get_password(system, username, desc=None):
@@ -0,0 +1,27 @@
+"""
+metrics hook
+
+cotton reports measurements (i.e. rsync transfer stats) through emit()
+they are logged as json by 'cotton.metrics' logger and passed to env.metrics_hook if set
+
+def send_to_statsd(name, data):
+    ...
+
+env.metrics_hook = send_to_statsd
+"""
+import json
+import logging
+
+from fabric.api import env
+
+logger = logging.getLogger('cotton.metrics')
+
+
+def emit(name, data):
+    """
+    name: metric name, i.e. 'rsync_project'
+    data: json serializable dictionary
+    """
+    logger.info("%s %s", name, json.dumps(data, sort_keys=True, default=str))
+    if 'metrics_hook' in env and env.metrics_hook:
+        env.metrics_hook(name, data)
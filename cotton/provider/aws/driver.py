@@ -1,6 +1,5 @@
 from __future__ import print_function
 import getpass
-import time
 import datetime
 import dateutil.parser
 import copy
@@ -10,12 +9,82 @@ import boto
 import boto.ec2
 import boto.cloudformation
 import boto.iam
+import boto.exception
 
 from fabric.api import env, prompt
 
 from cotton.colors import *
 from cotton.provider.driver import Provider
 from cotton.config import get_provider_zone_config
+from cotton.waiter import wait_for, progress_dots
+
+
+class InstanceInfo(object):
+    """
+    read only record with info about aws instance
+    behaves like a dictionary with keys: ip, hostname, id, type, placement,
+    state, architecture, age, tags, roles
+    """
+    __slots__ = ('ip', 'hostname', 'id', 'type', 'placement', 'state', 'architecture', 'launched', 'tags', 'roles')
+    _keys = ('ip', 'hostname', 'id', 'type', 'placement', 'state', 'architecture', 'age', 'tags', 'roles')
+
+    def __init__(self, server):
+        self.ip = server.private_ip_address
+        self.hostname = server.public_dns_name
+        self.id = server.id
+        self.type = server.instance_type
+        self.placement = server.placement
+        self.state = server.state
+        self.architecture = server.architecture
+        self.launched = dateutil.parser.parse(server.launch_time).replace(tzinfo=None)
+        tags = self.tags = dict(server.tags)
+
+        if "Role" in tags:
+            roles = [tags["Role"]]
+        elif "Roles" in tags:
+            roles = tags["Roles"].split(',')
+        elif "roles" in tags:
+            roles = tags["roles"].split(',')
+        else:
+            roles = []
+
+        self.roles = map(lambda x: x.encode('utf-8'), roles)
+
+    @property
+    def age(self):
+        return datetime.datetime.now() - self.launched
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, getattr(self, key)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
 
 
 class AWSProvider(Provider):
@@ -25,9 +94,14 @@ class AWSProvider(Provider):
     _route53_connection = None
     _s3_connection = None
     _iam_connection = None
+    _info_cache = None
 
     acl = dict()
 
+    # DescribeInstances page size
+    page_size = 1000
+    live_states = ['pending', 'running', 'stopping', 'stopped']
+
     def __init__(self, region_name=None, aws_access_key_id=None, aws_secret_access_key=None, **kwargs):
         """
         initializes connection object
@@ -97,25 +171,52 @@ class AWSProvider(Provider):
         return self._iam_connection
 
     def status(self):
-        instances = []
-        for reservation in self.connection.get_all_instances():
-            instance = reservation.instances[0]
-            if instance.state != 'terminated':
-                instance_data = self.info(instance)
-                instances.append(instance_data)
-        return instances
+        return list(self.iter_status())
+
+    def iter_status(self):
+        for instance in self.iter_instances(self._ec2_filters(states=self.live_states + ['shutting-down'])):
+            yield self.info(instance)
 
     def create(self, name=None, **kwargs):
         """
         return: aws instance object
         instance is booting so don't forget to cotton.fabextras.wait_for_shell()
         """
+        return self.create_many([name], **kwargs)[0]
+
+    def create_many(self, names, **kwargs):
+        """
+        launches all instances with a single RunInstances call and waits until all of them run
+        return: list of aws instance objects in order of names
+        """
         zone_config = get_provider_zone_config()
 
-        result = self.filter(name=name)
+        result = self.filter(filters={'tag:Name': list(names)})
         if result:
-            raise ValueError("VM name already in use")
+            raise ValueError("VM name already in use: {}".format(
+                ', '.join(sorted(set(instance.tags.get('Name', '') for instance in result)))))
+
+        run_instances_args = self._run_instances_args(zone_config)
+        run_instances_args['min_count'] = run_instances_args['max_count'] = len(names)
+
+        reservation = self.connection.run_instances(**run_instances_args)
+        instances = reservation.instances
+
+        for name, instance in zip(names, instances):
+            tags = {"Name": name, "creator": getpass.getuser()}
+            tags.update(kwargs.get('tags', {}))
+            # single CreateTags call for all tags
+            instance.add_tags(tags)
+
+        print("Waiting for {} to run".format(', '.join(instance.id for instance in instances)))
+        wait_for(lambda: self._update_instances(instances),
+                 timeout=zone_config.get('create_timeout', 600),
+                 progress=progress_dots,
+                 description="instances to run")
+        print(" OK")
+        return instances
 
+    def _run_instances_args(self, zone_config):
         run_instances_args = dict()
         run_instances_args['image_id'] = zone_config['image_id']
         run_instances_args['key_name'] = zone_config['provisioning_ssh_key_name']
@@ -144,27 +245,29 @@ class AWSProvider(Provider):
             bdm['/dev/sda1'] = dev_sda1
             run_instances_args['block_device_map'] = bdm
 
-        reservation = self.connection.run_instances(**run_instances_args)
-        instance = reservation.instances[0]
-
-        instance.add_tag("Name", name)
-        instance.add_tag("creator", getpass.getuser())
+        return run_instances_args
 
-        if 'tags' in kwargs:
-            for key in kwargs['tags']:
-                instance.add_tag(key, kwargs['tags'][key])
-
-        print("Waiting for instance to run",)
-        while instance.state != 'running':
-            instance.update()
-            sys.stdout.write(".")
-            sys.stdout.flush()
-            time.sleep(1)
-        print(" OK")
-        return instance
+    def _update_instances(self, instances):
+        """
+        refreshes state of all instances with one DescribeInstances call
+        returns True if all of them are running
+        """
+        by_id = dict((instance.id, instance) for instance in instances)
+        try:
+            reservations = self.connection.get_all_reservations(instance_ids=list(by_id))
+        except boto.exception.EC2ResponseError as e:
+            # freshly launched instances might not be visible yet
+            if e.error_code == 'InvalidInstanceID.NotFound':
+                return False
+            raise
+        for reservation in reservations:
+            for instance in reservation.instances:
+                if instance.id in by_id:
+                    by_id[instance.id]._update(instance)
+        return all(instance.state == 'running' for instance in instances)
 
     def terminate(self, server):
-        pprint.pprint(self.info(server))
+        pprint.pprint(dict(self.info(server)))
 
         if env.force:
             sure = 'T'
@@ -181,64 +284,120 @@ class AWSProvider(Provider):
         else:
             print("Aborting termination")
 
-    def filter(self, **kwargs):
+    def _reservations(self, filters=None):
+        """
+        yields reservations matching EC2 filters following DescribeInstances pagination
+        """
+        next_token = None
+        while True:
+            reservations = self.connection.get_all_reservations(filters=filters,
+                                                                max_results=self.page_size,
+                                                                next_token=next_token)
+            for reservation in reservations:
+                yield reservation
+            next_token = reservations.next_token
+            if not next_token:
+                break
+
+    def iter_instances(self, filters=None):
+        """
+        lazily yields every instance of every reservation matching EC2 filters
+        """
+        for reservation in self._reservations(filters):
+            for instance in reservation.instances:
+                yield instance
+
+    def _ec2_filters(self, name=None, tags=None, role=None, states=None, filters=None):
+        """
+        translates cotton filter arguments into EC2 DescribeInstances filters
+        """
+        ec2_filters = dict(filters or {})
+        if states is None:
+            states = self.live_states
+        if states:
+            ec2_filters['instance-state-name'] = list(states)
+        if name is not None:
+            ec2_filters['tag:Name'] = name
+        for key, value in (tags or {}).iteritems():
+            ec2_filters['tag:{}'.format(key)] = value
+        if role is not None:
+            # roles live in one of Role/Roles/roles tags (comma separated),
+            # EC2 can only narrow it down, exact match is done locally
+            ec2_filters['tag-value'] = '*{}*'.format(role)
+        return ec2_filters
+
+    def filter(self, name=None, tags=None, role=None, states=None, filters=None, **kwargs):
         """
         return: list of objects matching filter args
         typically provide should support filter 'name'='foo'
+
+        filtering happens on EC2 side:
+        name: value of Name tag ('*' and '?' wildcards allowed)
+        tags: dictionary of tag name -> value (or list of values, '*' wildcards allowed)
+        role: salt role as reported by info()['roles']
+        states: instance states, defaults to everything but terminated and shutting-down
+        filters: raw EC2 DescribeInstances filters
         """
+        if kwargs:
+            raise NotImplementedError("Unsupported filter: {}".format(', '.join(kwargs)))
+        if name is None and tags is None and role is None and filters is None:
+            raise NotImplementedError()
+
         instances = []
+        for instance in self.iter_instances(self._ec2_filters(name, tags, role, states, filters)):
+            if role is not None and role not in self.info(instance)['roles']:
+                continue
+            instances.append(instance)
+            print(green("Selected aws instance: {}".format(instance.id)))
 
-        if 'name' in kwargs:
-            name = kwargs['name']
-            selected = False
-            for reservation in self.connection.get_all_instances():
-                instance = reservation.instances[0]
-                if instance.state not in ['terminated', 'shutting-down']:
-                    if "Name" in instance.tags and instance.tags["Name"] == name:
-                        instances.append(instance)
-                        selected = True
-                        print(green("Selected aws instance: {}".format(instance.id)))
-
-            if not selected:
-                print(yellow("Warning: {} not found!".format(name), bold=True))
-        else:
-            raise NotImplementedError()
+        if not instances:
+            print(yellow("Warning: {} not found!".format(name or tags or role or filters), bold=True))
 
         return instances
 
     def info(self, server):
         """
-        returns dictionary with info about server
+        returns dictionary like InstanceInfo with info about server
+        records are memoized per instance id, state and tags
         """
-        info_dict = dict()
-        info_dict["ip"] = server.private_ip_address
-        info_dict["hostname"] = server.public_dns_name
-        info_dict["id"] = server.id
-        info_dict["type"] = server.instance_type
-        info_dict["placement"] = server.placement
-        info_dict["state"] = server.state
-        info_dict["architecture"] = server.architecture
-        info_dict["age"] = datetime.datetime.now()-dateutil.parser.parse(server.launch_time).replace(tzinfo=None)
-        tags = info_dict["tags"] = copy.deepcopy(server.tags)
-
-        if "Role" in tags:
-            info_dict["roles"] = [tags["Role"]]
-        elif "Roles" in tags:
-            info_dict["roles"] = tags["Roles"].split(',')
-        elif "roles" in tags:
-            info_dict["roles"] = tags["roles"].split(',')
-        else:
-            info_dict["roles"] = []
-
-        info_dict["roles"] = map(lambda x: x.encode('utf-8'), info_dict["roles"])
-
-        return info_dict
+        if self._info_cache is None:
+            self._info_cache = {}
+        key = (server.id, server.state, tuple(sorted(server.tags.items())))
+        info = self._info_cache.get(key, None)
+        if info is None:
+            info = self._info_cache[key] = InstanceInfo(server)
+        return info
+
+    def to_cache(self, server):
+        def detach(obj):
+            # boto objects keep a reference to the (unpicklable) connection
+            if isinstance(obj, list):
+                return [detach(item) for item in obj]
+            if hasattr(obj, '__dict__') and 'connection' in vars(obj):
+                obj = copy.copy(obj)
+                obj.connection = None
+                for key, value in vars(obj).items():
+                    vars(obj)[key] = detach(value)
+            return obj
+
+        server = detach(server)
+        server.tags = dict(server.tags)
+        return server
+
+    def from_cache(self, server):
+        server.connection = self.connection
+        server.region = self.connection.region
+        return server
+
+    def server_name(self, server):
+        return server.tags.get("Name", server.id)
 
     def host_string(self, server):
-        if self.info(server)["hostname"]:
+        info = self.info(server)
+        if info["hostname"]:
             # public dns entry is available
-            return self.info(server)["hostname"]
+            return info["hostname"]
         else:
             # only private ip is available so user will need to be using jumpbox
-            return self.info(server)["ip"]
+            return info["ip"]
 
@@ -0,0 +1,51 @@
+from __future__ import print_function
+import time
+
+from boto.ec2.instance import Instance
+from fabric.api import task
+
+from cotton.colors import *
+from cotton.provider.aws.driver import AWSProvider, InstanceInfo
+
+
+def _fake_instances(count):
+    instances = []
+    for i in range(count):
+        instance = Instance()
+        instance.id = 'i-{:08x}'.format(i)
+        instance.private_ip_address = '10.0.{}.{}'.format(i // 256 % 256, i % 256)
+        instance.public_dns_name = ''
+        instance.instance_type = 'm3.medium'
+        instance.launch_time = '2015-01-01T12:00:00.000Z'
+        instance._state.name = 'running'
+        instance.tags.update({'Name': 'host-{}'.format(i), 'Roles': 'web,app', 'env': 'benchmark'})
+        instances.append(instance)
+    return instances
+
+
+@task
+def info_benchmark(count=5000):
+    """
+    aws: compares cost of host_string + status row + roles lookup per instance with and without memoized info
+    """
+    instances = _fake_instances(int(count))
+    provider = AWSProvider.__new__(AWSProvider)
+
+    def consume(info):
+        for instance in instances:
+            # host_string, status table and reset_roles
+            info(instance)['hostname'] or info(instance)['ip']
+            dict(info(instance))
+            info(instance).get('roles', [])
+
+    start_time = time.time()
+    consume(InstanceInfo)
+    uncached = time.time() - start_time
+
+    start_time = time.time()
+    consume(provider.info)
+    cached = time.time() - start_time
+
+    print("instances: {}".format(len(instances)))
+    print("without memoization: {:.2f}s ({:.1f}us per instance)".format(uncached, uncached / len(instances) * 1e6))
+    print(green("with memoization:    {:.2f}s ({:.1f}us per instance)".format(cached, cached / len(instances) * 1e6)))
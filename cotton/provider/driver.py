@@ -13,12 +13,26 @@ class Provider(object):
     def status(self):
         raise NotImplementedError()
 
+    def iter_status(self):
+        """
+        yields status rows one by one
+        override if provider can list servers incrementally
+        """
+        return iter(self.status())
+
     def create(self, **kwargs):
         """
         return: server object
         """
         raise NotImplementedError()
 
+    def create_many(self, names, **kwargs):
+        """
+        return: list of server objects in order of names
+        override if provider can launch servers in bulk
+        """
+        return [self.create(name=name, **kwargs) for name in names]
+
     def terminate(self, server):
         raise NotImplementedError()
 
@@ -30,6 +44,16 @@ class Provider(object):
         """
         return: list of objects matching filter args
         typically provide should support filter 'name'='foo'
+        providers may also support:
+         - name as a glob, i.e. 'web-*'
+         - role='foo' (salt role as returned in info()['roles'])
+         - tags={'key': 'value'}
+        """
+        raise NotImplementedError()
+
+    def server_name(self, server):
+        """
+        returns name of server such that filter(name=name) selects it
         """
         raise NotImplementedError()
 
@@ -45,6 +69,19 @@ class Provider(object):
         """
         raise NotImplementedError()
 
+    def to_cache(self, server):
+        """
+        returns picklable version of server object (see cotton.provider.inventory)
+        i.e. stripped of connection objects
+        """
+        return server
+
+    def from_cache(self, server):
+        """
+        reverts to_cache()
+        """
+        return server
+
 
 
 def provider_class(provider_name):
@@ -0,0 +1,180 @@
+"""
+inventory cache shared by all provider drivers
+
+wraps initialized provider and caches results of filter() and status()
+for 'inventory_ttl' seconds (default 60), create() and terminate() drop the cache
+
+provider_zones:
+  aws_dev:
+    driver: aws
+    inventory_ttl: 300
+    inventory_disk_cache: true  # share results between fab invocations
+
+on-disk entries live in ~/.cache/cotton/inventory/<zone and zone config hash>/
+"""
+from __future__ import print_function
+import os
+import time
+import threading
+
+from cotton import cache
+from cotton.colors import *
+from cotton.provider.driver import Provider
+
+
+class InventoryCache(Provider):
+
+    default_ttl = 60
+
+    def __init__(self, provider, zone=None, inventory_ttl=None, inventory_disk_cache=False, **kwargs):
+        """
+        provider: initialized driver object
+        zone: provider zone name
+        kwargs: rest of the resolved zone config (driver, region, credentials, ...)
+
+        zone and zone config separate on-disk entries - projects may define
+        the same zone name for different accounts or regions
+        """
+        self.provider = provider
+        self.zone = zone
+        self.zone_config = kwargs
+        self.ttl = self.default_ttl if inventory_ttl is None else float(inventory_ttl)
+        self.disk_cache = bool(inventory_disk_cache) and cache.cache_enabled()
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        # driver specific attributes, i.e. connection
+        if name == 'provider':
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    def _cache_dir(self):
+        return cache.cache_dir('inventory', cache.cache_key(self.zone, sorted(self.zone_config.items())))
+
+    def _cache_file(self, key):
+        return os.path.join(self._cache_dir(), '{}.pickle'.format(cache.cache_key(key)))
+
+    def _get(self, key):
+        """
+        returns (hit, value)
+        """
+        if self.ttl <= 0:
+            return False, None
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                timestamp, value = self._entries[key]
+                if now - timestamp < self.ttl:
+                    return True, value
+                del self._entries[key]
+
+        if self.disk_cache:
+            entry = cache.load(self._cache_file(key))
+            if entry and now - entry['time'] < self.ttl:
+                value = entry['value']
+                if key[0] == 'filter':
+                    value = [self.provider.from_cache(server) for server in value]
+                with self._lock:
+                    self._entries[key] = (entry['time'], value)
+                return True, value
+        return False, None
+
+    def _set(self, key, value):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (now, value)
+
+        if self.disk_cache:
+            if key[0] == 'filter':
+                value = [self.provider.to_cache(server) for server in value]
+            try:
+                cache.dump(self._cache_file(key), {'time': now, 'value': value})
+            except Exception as e:
+                # i.e. driver objects that can't be pickled
+                print(yellow("Warning - unable to cache inventory: {}".format(e)))
+
+    def invalidate(self):
+        """
+        drops all cached results of this zone
+        """
+        with self._lock:
+            self._entries.clear()
+
+        if self.disk_cache:
+            cache_dir = self._cache_dir()
+            for name in os.listdir(cache_dir):
+                try:
+                    os.unlink(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+
+    def status(self):
+        key = ('status',)
+        hit, value = self._get(key)
+        if not hit:
+            value = self.provider.status()
+            self._set(key, value)
+        return value
+
+    def iter_status(self):
+        key = ('status',)
+        hit, value = self._get(key)
+        if hit:
+            for row in value:
+                yield row
+            return
+
+        rows = []
+        for row in self.provider.iter_status():
+            rows.append(row)
+            yield row
+        self._set(key, rows)
+
+    def filter(self, **kwargs):
+        key = ('filter', repr(sorted(kwargs.items())))
+        hit, value = self._get(key)
+        if not hit:
+            value = self.provider.filter(**kwargs)
+            self._set(key, value)
+        return list(value)
+
+    def exists(self, name):
+        return len(self.filter(name=name)) > 0
+
+    def create(self, **kwargs):
+        self.invalidate()
+        try:
+            return self.provider.create(**kwargs)
+        finally:
+            self.invalidate()
+
+    def create_many(self, names, **kwargs):
+        self.invalidate()
+        try:
+            return self.provider.create_many(names, **kwargs)
+        finally:
+            self.invalidate()
+
+    def terminate(self, server):
+        try:
+            return self.provider.terminate(server)
+        finally:
+            self.invalidate()
+
+    def info(self, server):
+        return self.provider.info(server)
+
+    def server_name(self, server):
+        return self.provider.server_name(server)
+
+    def host_string(self, server):
+        return self.provider.host_string(server)
+
+    def to_cache(self, server):
+        return self.provider.to_cache(server)
+
+    def from_cache(self, server):
+        return self.provider.from_cache(server)
@@ -14,6 +14,7 @@ provider_zone:
 
 """
 from __future__ import print_function
+import fnmatch
 from cotton.colors import *
 from cotton.provider.driver import Provider
 from cotton.config import get_provider_zone_config
@@ -41,30 +42,40 @@ class StaticProvider(Provider):
         name = kwargs['name']
         return self.filter(name=name)[0]
 
-    def filter(self, **kwargs):
+    def filter(self, name=None, role=None, tags=None, **kwargs):
         """
         return: list of objects matching filter args
         typically provide should support filter 'name'='foo'
+
+        name: glob matched against host name
+        role: one of host roles
+        tags: dictionary matched against host tags
         """
+        if kwargs or (name is None and role is None and tags is None):
+            raise NotImplementedError()
+
         instances = []
 
-        if 'name' in kwargs:
-            name = kwargs['name']
-
-            zone_config = get_provider_zone_config()
-            assert zone_config['driver'] == 'static'
-            for host_spec in zone_config['hosts']:
-                if host_spec['name'] == name:
-                    print("selected static instance: {}".format(host_spec['name']))
-                    instances.append(host_spec)
-                    break
-            else:
-                print(yellow("Warning: {} not found!".format(name), bold=True))
-        else:
-            raise NotImplementedError()
+        zone_config = get_provider_zone_config()
+        assert zone_config['driver'] == 'static'
+        for host_spec in zone_config['hosts']:
+            if name is not None and not fnmatch.fnmatchcase(host_spec['name'], name):
+                continue
+            if role is not None and role not in host_spec.get('roles', []):
+                continue
+            if tags is not None and any(host_spec.get('tags', {}).get(k) != v for k, v in tags.iteritems()):
+                continue
+            print("selected static instance: {}".format(host_spec['name']))
+            instances.append(host_spec)
+
+        if not instances:
+            print(yellow("Warning: {} not found!".format(name or role or tags), bold=True))
 
         return instances
 
+    def server_name(self, server):
+        return server['name']
+
     def info(self, server):
         """
         returns dictionary with info about server
@@ -1,5 +1,7 @@
 from __future__ import print_function
 from __future__ import absolute_import
+import copy
+import fnmatch
 from cotton.colors import *
 from cotton.provider.driver import Provider
 from cotton.config import get_provider_zone_config
@@ -73,13 +75,13 @@ class VCloudProvider(Provider):
     def filter(self, **kwargs):
         """
         return: list of objects matching filter args
-        typically provide should support filter 'name'='foo'
+        typically provide should support filter 'name'='foo' (name can be a glob)
         """
         if 'name' in kwargs:
             name = kwargs['name']
             vapps = []
             for vapp in self._filter_to_vdc(self.connection.list_nodes()):
-                if vapp.name == name:
+                if fnmatch.fnmatchcase(vapp.name, name):
                     vapps.append(vapp)
             return self._filter_to_vdc(vapps)
         elif len(kwargs) == 0:
@@ -101,6 +103,9 @@ class VCloudProvider(Provider):
             'size': self._find_node_size(vapp.size)
         }
 
+    def server_name(self, vapp):
+        return vapp.name
+
     def host_string(self, vapp):
         """
         returns host_string in fab format such that we can ssh to server
@@ -112,6 +117,15 @@ class VCloudProvider(Provider):
             print(red('Server IP is unknown'))
             return ''
 
+    def to_cache(self, vapp):
+        vapp = copy.copy(vapp)
+        vapp.driver = None
+        return vapp
+
+    def from_cache(self, vapp):
+        vapp.driver = self.connection
+        return vapp
+
     def _get_metadata(self, instance):
         #opportunity for grains storage, unused
         return self.connection.ex_get_metadata(instance)
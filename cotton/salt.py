@@ -9,7 +9,6 @@ import os
 import sys
 import pkgutil
 import tempfile
-import yaml
 import json
 
 from StringIO import StringIO
@@ -20,6 +19,7 @@ from pprint import pformat
 from fabric.api import env, put, sudo, task, get, abort
 
 from cotton.colors import red, yellow, green
+from cotton import yaml_utils
 from cotton.api import vm_task, get_provider_zone_config
 
 
@@ -85,7 +85,7 @@ def get_rendered_pillar_location(pillar_dir=None, projects_location=None, parse_
         except TemplateNotFound:
             raise RuntimeError("Missing top.sls in pillar location. Skipping rendering.")
 
-        top_content = yaml.load(top_sls)
+        top_content = yaml_utils.load(top_sls)
 
         filename = os.path.join(dest_location, 'top.sls')
         with open(filename, 'w') as f:
@@ -1,3 +1,4 @@
+import atexit
 import logging
 import os
 import sys
@@ -5,44 +6,63 @@ import re
 import tempfile
 import shutil
 import stat
-import errno
-
+import fcntl
+import hashlib
+import json
+import binascii
+import threading
+from collections import Counter, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import yaml
 from git import Repo
 from git.exc import GitCommandError
 from textwrap import dedent
 
-from fabric.api import local, task, env
+from fabric.api import task, env, sudo
+
+from cotton import cache, metrics, yaml_utils
+from cotton.common import is_true
 
 
 SSH_WRAPPER_SCRIPT = """#!/bin/bash
 ssh -o VisualHostKey=no "$@"
 """
 
-class GitSshEnvWrapper(object):
-    def __enter__(self):
-        """
-        Setup SSH to remove VisualHostKey - it breaks GitPython's attempt to
-        parse git output :(
-
-        Will delete file once the object gets GC'd
-        """
-
-        self.old_env_value = os.environ.get('GIT_SSH', None)
 
-        self.git_ssh_wrapper = tempfile.NamedTemporaryFile(prefix='cotton-git-ssh')
+class GitSshWrapper(object):
+    """
+    GIT_SSH script removing VisualHostKey - it breaks GitPython's attempt to
+    parse git output :(
 
-        self.git_ssh_wrapper.write(SSH_WRAPPER_SCRIPT)
-        self.git_ssh_wrapper.file.flush()
-        os.fchmod(self.git_ssh_wrapper.file.fileno(), stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
-        self.git_ssh_wrapper.file.close()
+    The script is written once (on first use) and passed to git through the
+    environment of each Repo object instead of os.environ, so worker threads
+    can use it at the same time. It is deleted at exit.
+    """
 
-        os.environ['GIT_SSH'] = self.git_ssh_wrapper.name
+    def __init__(self):
+        self.path = None
+        self._lock = threading.Lock()
+
+    def environment(self):
+        with self._lock:
+            if self.path is None:
+                fd, self.path = tempfile.mkstemp(prefix='cotton-git-ssh')
+                with os.fdopen(fd, 'w') as fh:
+                    fh.write(SSH_WRAPPER_SCRIPT)
+                os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+                atexit.register(self.close)
+        return {'GIT_SSH': self.path}
+
+    def apply(self, repo):
+        repo.git.update_environment(**self.environment())
+        return repo
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if self.old_env_value is not None:
-            os.environ['GIT_SSH'] = self.old_env_value
-        else:
-            os.environ.pop('GIT_SSH')
+    def close(self):
+        with self._lock:
+            if self.path is not None and os.path.exists(self.path):
+                os.unlink(self.path)
+            self.path = None
 
 
 class Shaker(object):
@@ -136,25 +156,76 @@ class Shaker(object):
         git@github.com:saltstack-formulas/users-formula.git
 
 
+    The formula-requirements.lock file
+    ----------------------------------
+
+    Every install writes the url, requested revision and resolved sha of all
+    formulas (including the ones required by other formulas) to
+    formula-requirements.lock next to formula-requirements.txt. Commit it.
+
+    ``install_requirements(from_lock=True)`` (``fab shaker:locked=1``) skips
+    resolving and installs exactly the locked shas in the locked order. Repos
+    are only fetched if a locked sha isn't present locally.
+
+
+    Shared formula mirrors
+    ----------------------
+
+    With ``use_mirror=True`` (``fab shaker:mirror=1``) every formula url gets a
+    bare mirror in ``~/.cache/cotton/formulas/<url hash>.git`` (or under
+    ``$COTTON_CACHE_DIR``) shared by all projects of the user. Fetches go to the
+    mirror and project clones borrow its objects via ``objects/info/alternates``
+    so each formula is downloaded and stored once per machine. Automatic gc is
+    disabled in mirrors - don't prune them while project clones use them.
+
+
+    Snapshots
+    ---------
+
+    ``export_snapshot()`` (``fab shaker:snapshot=1``) materialises what rsync -L
+    would see in ``vendor/_root`` as ``vendor/_snapshots/trees/<tree hash>``
+    made of hardlinks to files in ``vendor/_snapshots/blobs`` named by git blob
+    id, with ``<tree hash>.json`` manifest and ``current`` symlink. Unchanged
+    files keep their inode and mtime between snapshots so
+    ``rsync_snapshot()`` transfers only changed blobs, and nothing at all when
+    the remote already has the same tree hash::
+
+        shaker.install_requirements()
+        shaker.export_snapshot()
+        shaker.rsync_snapshot('/srv/salt-formulas', for_user='root')
+
+
     """
     dynamic_modules_dirs = ['_modules', '_grains', '_renderers', '_returners', '_states']
 
     def __init__(self, root_dir, salt_root_path='vendor',
-                 clone_path='formula-repos', salt_root='_root', formula_requirements_path = 'formula-requirements.txt'):
+                 clone_path='formula-repos', salt_root='_root', formula_requirements_path = 'formula-requirements.txt',
+                 pool_size=8, formula_lock_path=None, use_mirror=False, snapshots_path='_snapshots'):
         """
         There is a high chance you don't want to change the paths here.
 
         If you do, you'll need to change the paths in your salt config to ensure
         that there is an entry in `file_roots` that matches self.roots_dir
         (i.e., root_dir + salt_root_path + salt_root)
+
+        pool_size is the number of formula repos fetched at the same time
+        formula_lock_path defaults to formula_requirements_path with .lock extension
+        use_mirror shares fetched objects between projects (see above)
         """
         self.roots_dir = os.path.join(root_dir, salt_root_path, salt_root)
         self.repos_dir = os.path.join(root_dir, salt_root_path, clone_path)
+        self.pool_size = max(int(pool_size), 1)
 
         self._setup_logger()
-        self.fetched_formulas = {}
-        self.parsed_requirements_files = set()
+        # in install order - it decides which of the formulas wins a _modules file
+        self.fetched_formulas = OrderedDict()
         self.first_requirement_file = os.path.join(root_dir, formula_requirements_path)
+        if formula_lock_path is None:
+            formula_lock_path = os.path.splitext(formula_requirements_path)[0] + '.lock'
+        self.lock_file = os.path.join(root_dir, formula_lock_path)
+        self.mirror_dir = cache.cache_dir('formulas') if use_mirror and cache.cache_enabled() else None
+        self.git_ssh = GitSshWrapper()
+        self.snapshots_dir = os.path.join(root_dir, salt_root_path, snapshots_path)
         self.requirements_files = [
             self.first_requirement_file
         ]
@@ -164,16 +235,23 @@ class Shaker(object):
         # hack to avoid dependency hell until we get SemVer in
         self.override_version_from_toplevel = True
 
+        self.fetch_stats = Counter(local=0, ls_remotes=0, fetches=0, mirror_hits=0, baseline_round_trips=0)
+        self._remote_refs = {}
+        self._requirements_cache = {}
+        self._stats_lock = threading.Lock()
+
     def _create_dirs(self):
         """
         Keep this out of init, so we don't remove files without re-adding them.
         """
 
-        # Delete the salt roots dir on each run.
-        # This is because the files in roots_dir are just symlinks
-        if os.path.exists(self.roots_dir):
-            shutil.rmtree(self.roots_dir)
-        os.makedirs(self.roots_dir)
+        # The symlinks wanted in roots_dir are collected during the run
+        # and reconciled with what's on disk by _sync_roots_dir at the end
+        self.root_links = OrderedDict()
+        try:
+            os.makedirs(self.roots_dir)
+        except OSError:
+            pass
 
         # Ensure the repos_dir exists
         try:
@@ -236,32 +314,287 @@ class Shaker(object):
         with open(filename, 'r') as fh:
             return self.parse_requirements_lines(fh.readlines(), filename)
 
-    def install_requirements(self):
+    def install_requirements(self, from_lock=False):
+        if from_lock:
+            return self.install_from_lock()
+
         self._create_dirs()
 
-        while len(self.requirements_files):
-            req_file = self.requirements_files.pop()
-            if req_file in self.parsed_requirements_files:
-                # Already parsed.
-                continue
+        graph = self.resolve_graph()
+        if graph['clashes']:
+            raise RuntimeError("\n".join(graph['clashes']))
 
-            self.parsed_requirements_files.add(req_file)
+        self._checkout_levels(graph)
+        for formula in graph['formulas'].values():
+            self._link_formula(formula)
 
+        self._sync_roots_dir()
+        self.report_fetch_stats()
+        self.write_lock()
+
+    def resolve_graph(self):
+        """
+        Build the whole formula dependency graph before touching any work tree.
+
+        Revisions of all pending requirements are resolved in parallel, formula-requirements.txt
+        of every selected formula is read from its resolved commit (cached per
+        url and sha) and clashes are collected instead of raised. Returns::
+
+            {
+                'formulas': OrderedDict of selected formulas by name, in install order
+                'requires': OrderedDict of requested formulas (with 'status') by requiring formula
+                'levels': names of selected formulas per level - the checkout waves
+                'clashes': clash messages
+            }
+        """
+        graph = {'formulas': OrderedDict(), 'requires': OrderedDict(), 'levels': [], 'clashes': []}
+        self.fetched_formulas = graph['formulas']
+
+        # requirement files are walked depth first, last discovered first,
+        # like the former stack based walk - the order formulas are selected
+        # in decides which of them wins a _modules/_states/... file
+        stack = []
+        for req_file in self.requirements_files:
             self.logger.info("Checking %s" % req_file)
-            for formula in self.parse_requirements_file(req_file):
-                (repo_dir, _) = self.install_requirement(formula)
+            stack.append((os.path.basename(req_file), 0, list(self.parse_requirements_file(req_file))))
+
+        prefetched = set()
+        while stack:
+            # resolve everything already known to be required in parallel
+            unresolved = [formula for _, _, formulas in stack for formula in formulas if id(formula) not in prefetched]
+            prefetched.update(id(formula) for formula in unresolved)
+            self._prefetch(unresolved)
+
+            required_by, depth, formulas = stack.pop()
+            requires = graph['requires'].setdefault(required_by, [])
+            for formula in formulas:
+                status = self._select_formula(formula, graph)
+                requires.append({
+                    'name': formula['name'],
+                    'revision': formula['revision'],
+                    'sha': formula.get('sha'),
+                    'status': status,
+                })
+                if status == 'selected':
+                    # formulas at the same depth form one checkout wave
+                    while len(graph['levels']) <= depth:
+                        graph['levels'].append([])
+                    graph['levels'][depth].append(formula['name'])
+                    formula_requirements = self._formula_requirements(formula)
+                    if formula_requirements:
+                        self.logger.info("Adding requirements of {name} {revision}".format(**formula))
+                        stack.append((formula['name'], depth + 1, formula_requirements))
+
+        return graph
+
+    def _select_formula(self, formula, graph):
+        """
+        Apply top level overrides and clash checks to a requested formula,
+        returns 'selected', 'overridden', 'duplicate' or 'clash'
+        """
+        previously_fetched = graph['formulas'].get(formula['name'], None)
+        if previously_fetched is not None and previously_fetched['url'] != formula['url']:
+            graph['clashes'].append(self._url_clash(previously_fetched, formula))
+            return 'clash'
+
+        if self._is_overridden_from_toplevel(formula):
+            self.logger.info("Overriding {name} version of {new_ver} to {old_ver} from project formula requirements".format(
+                name=formula['name'],
+                new_ver=formula['revision'],
+                old_ver=previously_fetched['revision'],
+            ))
+            formula['sha'] = previously_fetched['sha']
+            return 'overridden'
 
-                self.fetched_formulas.setdefault(formula['name'], formula)
+        if 'sha' not in formula:
+            repo = self._open_repo(os.path.join(self.repos_dir, formula['name'] + "-formula"), formula['url'])
+            formula['sha'] = self._rev_to_sha(formula, repo)
 
-                # Check for recursive formula dep.
-                new_req_file = os.path.join(repo_dir, 'formula-requirements.txt')
-                if os.path.isfile(new_req_file):
-                    self.logger.info(
-                        "Adding {new} to check form {old} {revision}".format(
-                            new=new_req_file,
-                            old=req_file,
-                            revision=formula['revision']))
-                    self.requirements_files.append(new_req_file)
+        if previously_fetched is not None:
+            if previously_fetched['sha'] != formula['sha']:
+                graph['clashes'].append(self._revision_clash(previously_fetched, formula))
+                return 'clash'
+            return 'duplicate'
+
+        graph['formulas'][formula['name']] = formula
+        return 'selected'
+
+    def _formula_requirements(self, formula):
+        """
+        Returns requirements listed in formula-requirements.txt of the formula
+        at its resolved sha, parse results are cached per url and sha
+        """
+        repo_dir = os.path.join(self.repos_dir, formula['name'] + "-formula")
+        key = (str(formula['url']), str(formula['sha']))
+        requirements = self._requirements_cache.get(key)
+
+        cache_file = None
+        if requirements is None and cache.cache_enabled():
+            try:
+                cache_file = os.path.join(cache.cache_dir('shaker-requirements'), cache.cache_key(*key) + '.pickle')
+            except (IOError, OSError) as e:
+                self.logger.warning("Unable to cache requirements of {}: {}".format(formula['name'], e))
+            else:
+                requirements = cache.load(cache_file)
+
+        if requirements is None:
+            repo = self._open_repo(repo_dir, formula['url'])
+            try:
+                # GitPython returns unicode, requirement files are read as str
+                content = repo.git.show('{}:formula-requirements.txt'.format(formula['sha'])).encode('utf-8')
+            except GitCommandError:
+                content = ''
+            requirements = list(self.parse_requirements_lines(content.splitlines(), None))
+            if cache_file:
+                try:
+                    cache.dump(cache_file, requirements)
+                except (IOError, OSError) as e:
+                    self.logger.warning("Unable to cache requirements of {}: {}".format(formula['name'], e))
+        self._requirements_cache[key] = requirements
+
+        source = os.path.join(repo_dir, 'formula-requirements.txt')
+        return [dict(requirement, source=source) for requirement in requirements]
+
+    def _checkout_levels(self, graph):
+        """
+        Check out selected formulas level by level, pool_size repos at a time
+        """
+        for level in graph['levels']:
+            formulas = [graph['formulas'][name] for name in level]
+            pool = ThreadPool(min(self.pool_size, len(formulas)))
+            try:
+                pool.map_async(self._checkout, formulas).get(sys.maxint)
+            finally:
+                pool.close()
+                pool.join()
+
+    def _requirements_digest(self):
+        with open(self.first_requirement_file, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def write_lock(self):
+        """
+        Record every fetched formula with its resolved sha in self.lock_file
+        """
+        lock = {
+            'requirements_sha1': self._requirements_digest(),
+            'formulas': [
+                {
+                    'name': formula['name'],
+                    'url': formula['url'],
+                    'revision': formula['revision'],
+                    'sha': formula['sha'],
+                }
+                for formula in self.fetched_formulas.values()
+            ],
+        }
+        with open(self.lock_file, 'w') as fh:
+            fh.write("# generated by cotton salt shaker - do not edit\n")
+            yaml.safe_dump(lock, fh, default_flow_style=False)
+        self.logger.info("Wrote %s" % self.lock_file)
+
+    def read_lock(self):
+        """
+        Returns formulas from self.lock_file, refuses a lock that doesn't match
+        the current formula-requirements.txt
+        """
+        if not os.path.isfile(self.lock_file):
+            raise RuntimeError("%s doesn't exist - run shaker without locked first" % self.lock_file)
+        lock = yaml_utils.load_file(self.lock_file)
+        if lock.get('requirements_sha1') != self._requirements_digest():
+            raise RuntimeError("%s is out of date with %s - run shaker without locked to update it" % (
+                self.lock_file, self.first_requirement_file))
+        return lock['formulas']
+
+    def install_from_lock(self):
+        """
+        Install exactly the formulas and shas recorded in self.lock_file
+        without parsing formula-requirements.txt files or resolving revisions
+        """
+        formulas = self.read_lock()
+        self._create_dirs()
+
+        for locked in formulas:
+            formula = dict(locked, source=self.lock_file, explicit_revision=True)
+            repo_dir = os.path.join(self.repos_dir, formula['name'] + "-formula")
+            repo = self._open_repo(repo_dir, formula['url'])
+            if not self._has_commit(repo, formula['sha']):
+                sys.stdout.write("Fetching %s for locked %s\n" % (formula['url'], formula['sha'][0:7]))
+                self._fetch(repo, want=formula['sha'])
+                if not self._has_commit(repo, formula['sha']):
+                    raise RuntimeError("%s: locked sha %s not found in %s" % (
+                        formula['name'], formula['sha'], formula['url']))
+            self.install_requirement(formula)
+            self.fetched_formulas.setdefault(formula['name'], formula)
+
+        self._sync_roots_dir()
+
+    def _has_commit(self, repo, sha):
+        try:
+            repo.git.rev_parse('{}^{{commit}}'.format(sha))
+            return True
+        except GitCommandError:
+            return False
+
+    def _is_overridden_from_toplevel(self, formula):
+        previously_fetched = self.fetched_formulas.get(formula['name'], None)
+        return previously_fetched is not None and \
+            previously_fetched.get('top_level_requirement', False) and \
+            previously_fetched['explicit_revision'] and self.override_version_from_toplevel
+
+    def _prefetch(self, formulas):
+        """
+        Resolve revisions of `formulas` in parallel (pool_size repos at a time)
+        and store them in formula['sha'] so _select_formula doesn't have to
+        hit the network. Formulas sharing a repo are resolved by one worker.
+
+        Failures are only logged - _select_formula resolves those formulas
+        again and raises in requirement order.
+
+        Only formulas whose url can still be selected are resolved, the clone
+        of a formula must never be fetched from a clashing url.
+        """
+        by_repo = OrderedDict()
+        for formula in formulas:
+            if 'sha' not in formula and not self._is_overridden_from_toplevel(formula):
+                by_repo.setdefault(formula['name'], []).append(formula)
+
+        for name, group in by_repo.items():
+            selected = self.fetched_formulas.get(name, None)
+            if selected is not None:
+                # URL clashes are reported by _select_formula
+                group = [formula for formula in group if formula['url'] == selected['url']]
+            elif len(set(formula['url'] for formula in group)) > 1:
+                # which url wins is only known once one of them gets selected
+                group = []
+            if group:
+                by_repo[name] = group
+            else:
+                del by_repo[name]
+
+        if not by_repo:
+            return
+
+        def resolve(group):
+            repo_dir = os.path.join(self.repos_dir, group[0]['name'] + "-formula")
+            resolved = {}
+            for formula in group:
+                try:
+                    if formula['revision'] not in resolved:
+                        repo = self._open_repo(repo_dir, formula['url'])
+                        resolved[formula['revision']] = self._rev_to_sha(formula, repo)
+                    formula['sha'] = resolved[formula['revision']]
+                except Exception as e:
+                    self.logger.debug("Prefetch of {name} {revision} failed: {error}".format(
+                        name=formula['name'], revision=formula['revision'], error=e))
+
+        pool = ThreadPool(min(self.pool_size, len(by_repo)))
+        try:
+            # get() with timeout keeps the main thread responsive to Ctrl-c
+            pool.map_async(resolve, by_repo.values()).get(sys.maxint)
+        finally:
+            pool.close()
+            pool.join()
 
     def check_for_version_clash(self, formula):
         """
@@ -272,16 +605,30 @@ class Shaker(object):
         previously_fetched = self.fetched_formulas.get(formula['name'], None)
         if previously_fetched:
             if previously_fetched['url'] != formula['url']:
-                raise RuntimeError(dedent("""
-                    Formula URL clash for {name}:
-                    - {old[url]} (defined in {old[source]})
-                    + {new[url]} (defined in {new[source]})""".format(
-                    name=formula['name'],
-                    old=previously_fetched,
-                    new=formula)
-                ))
+                raise RuntimeError(self._url_clash(previously_fetched, formula))
         return previously_fetched
 
+    def _url_clash(self, old, new):
+        return dedent("""
+            Formula URL clash for {name}:
+            - {old[url]} (defined in {old[source]})
+            + {new[url]} (defined in {new[source]})""".format(
+            name=new['name'],
+            old=old,
+            new=new)
+        )
+
+    def _revision_clash(self, old, new):
+        return dedent("""
+            Formula revision clash for {new[name]}:
+            - {old[revision]} <{old_sha}> (defined in {old[source]})
+            + {new[revision]} <{new_sha}> (defined in {new[source]})""".format(
+            old=old,
+            old_sha=old['sha'][0:7],
+            new=new,
+            new_sha=new['sha'][0:7])
+        )
+
     def install_requirement(self, formula):
         """
         Install the requirement as specified by the formula dictionary and
@@ -291,41 +638,56 @@ class Shaker(object):
 
         repo_dir = os.path.join(self.repos_dir, formula['name'] + "-formula")
 
-        with GitSshEnvWrapper():
-            repo = self._open_repo(repo_dir, formula['url'])
+        repo = self._open_repo(repo_dir, formula['url'])
 
-            sha = self._fetch_and_resolve_sha(formula, repo)
+        sha = self._fetch_and_resolve_sha(formula, repo)
 
-            target = os.path.join(self.roots_dir, formula['name'])
-            if sha is None:
-                if not os.path.exists(target):
-                    raise RuntimeError("%s: Formula marked as resolved but target '%s' didn't exist" % (formula['name'], target))
-                return repo_dir, target
+        target = os.path.join(self.roots_dir, formula['name'])
+        if sha is None:
+            if formula['name'] not in self.root_links:
+                raise RuntimeError("%s: Formula marked as resolved but target '%s' didn't exist" % (formula['name'], target))
+            return repo_dir, target
+
+        self._checkout(formula, repo)
+        self._link_formula(formula)
+
+        return repo_dir, target
+
+    def _checkout(self, formula, repo=None):
+        """
+        Reset work tree of the formula repo to formula['sha']
+        """
+        sha = formula['sha']
+        if repo is None:
+            repo = self._open_repo(os.path.join(self.repos_dir, formula['name'] + "-formula"), formula['url'])
 
-            # TODO: Check if the working tree is dirty, and (if request/flagged)
-            # reset it to this sha
-            if not repo.head.is_valid():
-                logging.debug("Resetting invalid head on: {}\n".format(formula['name']))
-                repo.head.reset(commit=sha, index=True, working_tree=True)
+        # TODO: Check if the working tree is dirty, and (if request/flagged)
+        # reset it to this sha
+        if not repo.head.is_valid():
+            logging.debug("Resetting invalid head on: {}\n".format(formula['name']))
+            repo.head.reset(commit=sha, index=True, working_tree=True)
 
-            if repo.head.commit.hexsha != sha:
-                logging.debug("Resetting sha mismatch on: {}\n".format(formula['name']))
-                repo.head.reset(commit=sha, index=True, working_tree=True)
+        if repo.head.commit.hexsha != sha:
+            logging.debug("Resetting sha mismatch on: {}\n".format(formula['name']))
+            repo.head.reset(commit=sha, index=True, working_tree=True)
 
-            self.logger.debug("{formula[name]} is at {formula[revision]}".format(formula=formula))
+        self.logger.debug("{formula[name]} is at {formula[revision]}".format(formula=formula))
 
+    def _link_formula(self, formula):
+        """
+        Record links of the checked out formula in self.root_links
+        """
+        repo_dir = os.path.join(self.repos_dir, formula['name'] + "-formula")
+        target = os.path.join(self.roots_dir, formula['name'])
         source = os.path.join(repo_dir, formula['name'])
-        if os.path.exists(target):
+        if formula['name'] in self.root_links:
             raise RuntimeError("%s: Target '%s' conflicts with something else" % (formula['name'], target))
 
         if os.path.exists(source):
-            relative_source = os.path.relpath(source, os.path.dirname(target))
-            os.symlink(relative_source, target)
+            self.root_links[formula['name']] = os.path.relpath(source, os.path.dirname(target))
 
         self._link_dynamic_modules(formula)
 
-        return repo_dir, target
-
     def _link_dynamic_modules(self, formula):
         repo_dir = os.path.join(self.repos_dir, formula['name'] + "-formula")
 
@@ -336,21 +698,271 @@ class Shaker(object):
             relative_source = os.path.relpath(sourcedir, targetdir)
 
             if os.path.isdir(sourcedir):
-                for name in os.listdir(sourcedir):
-                    if not os.path.isdir(targetdir):
-                        os.mkdir(targetdir)
+                for name in sorted(os.listdir(sourcedir)):
                     sourcefile = os.path.join(relative_source, name)
-                    targetfile = os.path.join(targetdir, name)
-                    try:
+                    targetfile = os.path.join(libdir, name)
+                    if targetfile in self.root_links:
+                        self.logger.info(
+                            "skipping to linking {} as there is a file with higher priority already there".
+                            format(sourcefile))
+                    else:
                         self.logger.info("linking {}".format(sourcefile))
-                        os.symlink(sourcefile, targetfile)
-                    except OSError as e:
-                        if e.errno == errno.EEXIST:  # already exist
-                            self.logger.info(
-                                "skipping to linking {} as there is a file with higher priority already there".
-                                format(sourcefile))
-                        else:
-                            raise
+                        self.root_links[targetfile] = sourcefile
+
+    def _sync_roots_dir(self):
+        """
+        Make roots_dir contain exactly self.root_links touching only entries
+        that differ, so unchanged symlinks keep their mtimes for rsync
+        """
+        counts = Counter(added=0, removed=0, retargeted=0, unchanged=0)
+
+        def remove(path):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            counts['removed'] += 1
+
+        wanted_dirs = set(os.path.dirname(link) for link in self.root_links if os.path.dirname(link))
+        for name in os.listdir(self.roots_dir):
+            path = os.path.join(self.roots_dir, name)
+            if name in wanted_dirs and os.path.isdir(path) and not os.path.islink(path):
+                for module in os.listdir(path):
+                    if os.path.join(name, module) not in self.root_links:
+                        remove(os.path.join(path, module))
+            elif name not in self.root_links:
+                remove(path)
+
+        for name in wanted_dirs:
+            path = os.path.join(self.roots_dir, name)
+            if os.path.islink(path) or (os.path.exists(path) and not os.path.isdir(path)):
+                remove(path)
+            if not os.path.isdir(path):
+                os.mkdir(path)
+
+        for link, source in self.root_links.iteritems():
+            target = os.path.join(self.roots_dir, link)
+            if os.path.islink(target):
+                if os.readlink(target) == source:
+                    counts['unchanged'] += 1
+                    continue
+                counts['retargeted'] += 1
+            elif os.path.lexists(target):
+                remove(target)
+                counts['added'] += 1
+            else:
+                counts['added'] += 1
+            # replace atomically so the roots dir is never missing the entry
+            tmp_target = os.path.join(os.path.dirname(target), '.{}.tmp'.format(os.path.basename(target)))
+            if os.path.lexists(tmp_target):
+                os.unlink(tmp_target)
+            os.symlink(source, tmp_target)
+            os.rename(tmp_target, target)
+
+        self.logger.info("{} links: {added} added, {removed} removed, {retargeted} retargeted, {unchanged} unchanged".format(
+            self.roots_dir, **counts))
+
+    def _snapshot_entries(self):
+        """
+        Yields (path, mode, blob id, repo) of every file reachable through
+        self.root_links, taken from the git trees of the resolved shas
+        """
+        if not hasattr(self, 'root_links'):
+            raise RuntimeError("Nothing to snapshot - run install_requirements first")
+
+        shas = dict((formula['name'] + "-formula", formula['sha']) for formula in self.fetched_formulas.values())
+        repos = {}
+        for link, source in self.root_links.iteritems():
+            source = os.path.normpath(os.path.join(self.roots_dir, os.path.dirname(link), source))
+            repo_name, repo_path = os.path.relpath(source, self.repos_dir).split(os.sep, 1)
+            if repo_name not in repos:
+                repos[repo_name] = Repo(os.path.join(self.repos_dir, repo_name))
+            repo = repos[repo_name]
+
+            for line in repo.git.ls_tree('-r', '-z', shas[repo_name], '--', repo_path).split('\0'):
+                if not line:
+                    continue
+                info, path = line.split('\t', 1)
+                mode, kind, blob = info.split()
+                if kind != 'blob':
+                    # submodules
+                    continue
+                yield link + path[len(repo_path):], mode, blob, repo
+
+    def _store_blob(self, repo, blob, mode):
+        """
+        Returns path of blob in the snapshot store, adding it if needed
+        """
+        blob_path = os.path.join(self.snapshots_dir, 'blobs', blob + ('.x' if mode == '100755' else ''))
+        if not os.path.exists(blob_path):
+            data = repo.odb.stream(binascii.unhexlify(blob)).read()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.chmod(tmp_path, 0755 if mode == '100755' else 0644)
+            os.rename(tmp_path, blob_path)
+        return blob_path
+
+    def export_snapshot(self, keep=3):
+        """
+        Materialise the installed formulas as a content addressed snapshot
+        (see class docs), keeps `keep` most recent trees and the blobs they use.
+        Returns (tree hash, tree dir).
+        """
+        entries = sorted(self._snapshot_entries())
+        tree_hash = hashlib.sha1(''.join(
+            "{} {} {}\n".format(mode, blob, path) for path, mode, blob, _ in entries)).hexdigest()
+
+        trees_dir = os.path.join(self.snapshots_dir, 'trees')
+        for path in (trees_dir, os.path.join(self.snapshots_dir, 'blobs')):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        tree_dir = os.path.join(trees_dir, tree_hash)
+        if not os.path.isdir(tree_dir):
+            tmp_dir = tempfile.mkdtemp(dir=trees_dir, prefix='.tmp-')
+            manifest = {'tree': tree_hash, 'files': {}}
+            for path, mode, blob, repo in entries:
+                target = os.path.join(tmp_dir, path)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                if mode == '120000':
+                    os.symlink(repo.odb.stream(binascii.unhexlify(blob)).read(), target)
+                else:
+                    os.link(self._store_blob(repo, blob, mode), target)
+                manifest['files'][path] = {'mode': mode, 'blob': blob}
+            os.chmod(tmp_dir, 0755)
+            with open(tree_dir + '.json', 'w') as fh:
+                json.dump(manifest, fh, indent=1, sort_keys=True)
+            os.rename(tmp_dir, tree_dir)
+            self.logger.info("Exported snapshot {} ({} files)".format(tree_hash, len(entries)))
+        else:
+            os.utime(tree_dir, None)
+
+        current = os.path.join(self.snapshots_dir, 'current')
+        tmp_current = current + '.tmp'
+        if os.path.lexists(tmp_current):
+            os.unlink(tmp_current)
+        os.symlink(os.path.join('trees', tree_hash), tmp_current)
+        os.rename(tmp_current, current)
+
+        self._prune_snapshots(keep)
+        return tree_hash, tree_dir
+
+    def _prune_snapshots(self, keep):
+        trees_dir = os.path.join(self.snapshots_dir, 'trees')
+        trees = sorted((os.path.join(trees_dir, name) for name in os.listdir(trees_dir) if not name.endswith('.json')),
+                       key=os.path.getmtime, reverse=True)
+        for tree_dir in trees[max(int(keep), 1):]:
+            shutil.rmtree(tree_dir)
+            if os.path.exists(tree_dir + '.json'):
+                os.unlink(tree_dir + '.json')
+
+        # blobs that no tree hardlinks to anymore
+        blobs_dir = os.path.join(self.snapshots_dir, 'blobs')
+        for name in os.listdir(blobs_dir):
+            path = os.path.join(blobs_dir, name)
+            if os.lstat(path).st_nlink == 1:
+                os.unlink(path)
+
+    def current_snapshot(self):
+        """
+        Returns (tree hash, tree dir) of the last exported snapshot
+        """
+        current = os.path.join(self.snapshots_dir, 'current')
+        if not os.path.islink(current):
+            raise RuntimeError("No snapshot in %s - run export_snapshot first" % self.snapshots_dir)
+        tree_dir = os.path.join(self.snapshots_dir, os.readlink(current))
+        return os.path.basename(tree_dir), tree_dir
+
+    def rsync_snapshot(self, remote_dir, **kwargs):
+        """
+        smart_rsync_project the current snapshot to remote_dir unless the
+        remote already has it (remote_dir/.cotton-snapshot holds the tree hash)
+        accepts the same arguments as smart_rsync_project
+        """
+        from cotton.fabextras import smart_rsync_project
+
+        tree_hash, tree_dir = self.current_snapshot()
+        marker = os.path.join(remote_dir, '.cotton-snapshot')
+        if sudo("cat {} 2>/dev/null || true".format(marker), quiet=True).strip() == tree_hash:
+            print("[%s] rsync_snapshot: %s already has %s" % (env.host_string, remote_dir, tree_hash))
+            return None
+
+        kwargs.setdefault('delete', True)
+        ret = smart_rsync_project(remote_dir, tree_dir + '/', **kwargs)
+        sudo("echo {} > {}".format(tree_hash, marker))
+        return ret
+
+    def _read_lock_entries(self):
+        # informational, so a lock out of date with requirements is fine here
+        if not os.path.isfile(self.lock_file):
+            return {}
+        lock = yaml_utils.load_file(self.lock_file) or {}
+        return dict((entry['name'], entry) for entry in lock.get('formulas', []))
+
+    @staticmethod
+    def _version_key(tag):
+        # v1.10.0 > v1.9.2
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', tag)]
+
+    def _formula_version(self, repo_dir, name, locked, check_remote):
+        repo = self.git_ssh.apply(Repo(repo_dir))
+
+        sha = repo.head.commit.hexsha if repo.head.is_valid() else None
+        try:
+            current = repo.git.describe('--tags')
+        except GitCommandError:
+            current = sha[0:7] if sha else 'no commits'
+
+        row = {
+            'formula': name,
+            'current': current,
+            'sha': sha[0:7] if sha else '',
+            'locked': "{}@{}".format(locked['revision'], locked['sha'][0:7]) if locked else '',
+            'matches_lock': bool(locked) and locked['sha'] == sha,
+        }
+
+        if check_remote:
+            # ls-remote only lists tags, nothing is downloaded
+            tags = set()
+            for line in repo.git.ls_remote('--tags', 'origin').splitlines():
+                ref = line.split('\t', 1)[1]
+                tags.add(re.sub(r'\^\{\}$', '', ref)[len('refs/tags/'):])
+            try:
+                current_tag = repo.git.describe('--tags', '--abbrev=0')
+            except GitCommandError:
+                current_tag = None
+            row['latest'] = max(tags, key=self._version_key) if tags else 'no tags'
+            row['outdated'] = bool(tags) and row['latest'] != current_tag
+        return row
+
+    def formula_versions(self, check_remote=False):
+        """
+        Returns a row per repo in repos_dir with the checked out version and
+        the locked one, check_remote=True adds the latest tag upstream.
+        Repos are inspected pool_size at a time.
+        """
+        if not os.path.isdir(self.repos_dir):
+            return []
+        locked = self._read_lock_entries()
+        repo_dirs = sorted(os.path.join(self.repos_dir, name) for name in os.listdir(self.repos_dir)
+                           if os.path.isdir(os.path.join(self.repos_dir, name, '.git')))
+        if not repo_dirs:
+            return []
+
+        def version(repo_dir):
+            name = os.path.basename(repo_dir)
+            if name.endswith('-formula'):
+                name = name[:-len('-formula')]
+            return self._formula_version(repo_dir, name, locked.get(name), check_remote)
+
+        pool = ThreadPool(min(self.pool_size, len(repo_dirs)))
+        try:
+            return pool.map_async(version, repo_dirs).get(sys.maxint)
+        finally:
+            pool.close()
+            pool.join()
 
     def _fetch_and_resolve_sha(self, formula, repo):
         """
@@ -361,9 +973,7 @@ class Shaker(object):
 
         previously_fetched = self.fetched_formulas.get(formula['name'], None)
 
-        if previously_fetched is not None and \
-           previously_fetched.get('top_level_requirement', False) and \
-           previously_fetched['explicit_revision'] and self.override_version_from_toplevel:
+        if self._is_overridden_from_toplevel(formula):
             self.logger.info("Overriding {name} version of {new_ver} to {old_ver} from project formula requirements".format(
                 name=formula['name'],
                 new_ver=formula['revision'],
@@ -389,129 +999,324 @@ class Shaker(object):
             # The revisions might be specified as different strings but
             # resolve to the same. So resolve both and check
             if previously_fetched['sha'] != formula['sha']:
-
-                raise RuntimeError(dedent("""
-                    Formula revision clash for {new[name]}:
-                    - {old[revision]} <{old_sha}> (defined in {old[source]})
-                    + {new[revision]} <{new_sha}> (defined in {new[source]})""".format(
-                    old=previously_fetched,
-                    old_sha=previously_fetched['sha'][0:7],
-                    new=formula,
-                    new_sha=formula['sha'][0:7])
-                ))
+                raise RuntimeError(self._revision_clash(previously_fetched, formula))
 
             # Nothing needed - we're already at a suitable sha from when we
             # fetched it previously this run
             return None
 
-        return target_sha
+        return formula['sha']
 
     def _open_repo(self, repo_dir, upstream_url):
         # Split things out into multiple steps and checks to be Ctrl-c resilient
         if os.path.isdir(repo_dir):
             repo = Repo(repo_dir)
+            try:
+                origin_url = repo.remotes.origin.url
+            except AttributeError:
+                origin_url = upstream_url
+            if origin_url != upstream_url:
+                # tags and shas known locally are trusted, nothing fetched
+                # from another url may be reused
+                self.logger.warning("Recreating {} - origin {} is not {}".format(repo_dir, origin_url, upstream_url))
+                shutil.rmtree(repo_dir)
+                repo = Repo.init(repo_dir)
         else:
             repo = Repo.init(repo_dir)
+        self.git_ssh.apply(repo)
 
         try:
             repo.remotes.origin
         except AttributeError:
             repo.create_remote('origin', upstream_url)
+
+        if self.mirror_dir:
+            self._link_mirror(repo, self._open_mirror(upstream_url))
         return repo
 
-    def _rev_to_sha(self, formula, repo):
+    def _open_mirror(self, upstream_url):
         """
-        Try to resovle the revision into a SHA. If rev is a tag or a SHA then
-        try to avoid doing a fetch on the repo if we already know about it. If
-        it is a branch then make sure it is the tip of that branch (i.e. this
-        will do a git fetch on the repo)
+        Returns bare mirror repo of upstream_url shared by all projects
         """
+        # GitPython returns remote urls as unicode
+        mirror_dir = os.path.join(self.mirror_dir, cache.cache_key(str(upstream_url)) + '.git')
+        with open(mirror_dir + '.lock', 'w') as lock:
+            # other projects may be setting up the same mirror
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(mirror_dir):
+                mirror = Repo(mirror_dir)
+            else:
+                mirror = Repo.init(mirror_dir, bare=True)
 
-        have_updated = False
-        is_branch = False
-        sha = None
-        origin = repo.remotes.origin
-
-        for attempt in range(0, 2):
             try:
-                # Try a tag first. Treat it as immutable so if we find it then
-                # we don't have to fetch the remote repo
-                tag = repo.tags[formula['revision']]
-                return tag.commit.hexsha
-            except IndexError:
-                pass
+                mirror.remotes.origin
+            except AttributeError:
+                # objects borrowed by project clones must never be pruned
+                mirror.git.config('gc.auto', '0')
+                mirror.create_remote('origin', upstream_url)
+        self.git_ssh.apply(mirror)
+        return mirror
+
+    def _link_mirror(self, repo, mirror):
+        alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+        objects_dir = os.path.join(mirror.git_dir, 'objects')
+        if os.path.isfile(alternates):
+            with open(alternates) as fh:
+                if objects_dir in fh.read().splitlines():
+                    return
+        with open(alternates, 'a') as fh:
+            fh.write(objects_dir + '\n')
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self.fetch_stats[key] += value
+
+    def _fetch(self, repo, refspec=None, want=None, **kwargs):
+        """
+        Single fetch of all branches and tags unless refspec is given
 
+        With a mirror the network fetch goes to the mirror and the project
+        clone fetches refs from it, the mirror fetch is skipped if it already
+        has the `want` commit and the requested refs
+        """
+        if refspec is None:
+            refspec = ['+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*']
+        if isinstance(refspec, basestring):
+            refspec = [refspec]
+
+        if not self.mirror_dir:
+            self._count('fetches')
+            repo.remotes.origin.fetch(refspec=refspec, **kwargs)
+            return
+
+        mirror = self._open_mirror(repo.remotes.origin.url)
+        with open(mirror.git_dir + '.lock', 'w') as lock:
+            # other projects may be updating the same mirror
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            mirror_hit = self._mirror_has(mirror, refspec, want)
+            if mirror_hit:
+                self._count('mirror_hits')
+            else:
+                self._update_mirror(mirror, refspec)
+
+        try:
+            repo.git.fetch(mirror.git_dir, *refspec)
+        except GitCommandError:
+            if not mirror_hit:
+                raise
+            # the mirror lacks something after all - update it and try again
+            with open(mirror.git_dir + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._update_mirror(mirror, refspec)
+            repo.git.fetch(mirror.git_dir, *refspec)
+
+    def _update_mirror(self, mirror, refspec):
+        self._count('fetches')
+        # mirror keeps branches as branches, full history (no depth)
+        mirror.remotes.origin.fetch(refspec=[
+            spec.replace(':refs/remotes/origin/', ':refs/heads/') for spec in refspec])
+
+    def _mirror_has(self, mirror, refspec, want):
+        """
+        True if the mirror has the `want` commit and every (non glob) ref
+        of refspec, pointing to it - i.e. upstream may have just tagged
+        a commit the mirror already has, the tag has to be fetched anyway
+        """
+        if want is None or not self._has_commit(mirror, want):
+            return False
+        for spec in refspec:
+            source = spec.lstrip('+').split(':', 1)[0]
+            if '*' in source:
+                continue
             try:
-                # Next check for a branch - if it is one then we want to udpate
-                # as it might have changed since we last fetched
-                (full_ref,) = filter(lambda r: r.remote_head == formula['revision'], origin.refs)
-                is_branch = True
-
-                # Don't treat the sha as resolved until we've updated the
-                # remote
-                if have_updated:
-                    sha = full_ref.commit.hexsha
-            except (ValueError, AssertionError):
-                pass
-
-            # Could just be a SHA
-            try:
-                if not is_branch:
-                    # Don't try to pass it to `git rev-parse` if we know it's a
-                    # branch - this would just return the *current* SHA but we
-                    # want to force an update
-                    #
-                    # The $sha^{object} syntax says that this is a SHA *and
-                    # that* it is known in this repo. Without this git will
-                    # happily take a full sha and go 'yep, that looks like a
-                    #  valid sha. Tick'
-                    sha = repo.git.rev_parse('{formula[revision]}^{{object}}'.format(formula=formula))
+                if mirror.git.rev_parse('{}^{{commit}}'.format(source)) != want:
+                    return False
             except GitCommandError:
-                # Maybe we just need to fetch first.
-                pass
+                return False
+        return True
 
-            if sha is not None:
-                return sha
+    def _ls_remote(self, repo):
+        """
+        Returns {ref: sha} advertised by origin (heads and tags only),
+        cached for the run
+        """
+        url = repo.remotes.origin.url
+        with self._stats_lock:
+            if url in self._remote_refs:
+                return self._remote_refs[url]
+
+        self._count('ls_remotes')
+        refs = {}
+        for line in repo.git.ls_remote('--heads', '--tags', 'origin').splitlines():
+            sha, ref = line.split('\t', 1)
+            refs[ref] = sha
+
+        with self._stats_lock:
+            self._remote_refs[url] = refs
+        return refs
+
+    def _local_tag_sha(self, repo, revision):
+        try:
+            return repo.tags[revision].commit.hexsha
+        except IndexError:
+            return None
+
+    def _local_sha(self, repo, revision):
+        # The $sha^{object} syntax says that this is a SHA *and that* it is
+        # known in this repo. Without this git will happily take a full sha
+        # and go 'yep, that looks like a valid sha. Tick'
+        try:
+            return repo.git.rev_parse('{}^{{object}}'.format(revision))
+        except GitCommandError:
+            return None
 
-            if have_updated:
-                # If we've already updated once and get here then we can't find it :(
-                raise RuntimeError("Could not find out what revision '{rev}' was for {url} (defined in {source}".format(
-                    rev=formula['revision'],
-                    url=formula['url'],
-                    source=formula['source'],
-                ))
+    def _rev_to_sha(self, formula, repo):
+        """
+        Resolve the revision into a SHA with as few network round trips as
+        possible:
+
+        - tags and SHAs known locally are treated as immutable, no network
+        - otherwise `git ls-remote` tells if it is a branch or a tag; a branch
+          whose tip is already local doesn't need a fetch
+        - a tag is fetched on its own (shallow into a fresh clone)
+        - anything else gets one fetch of all branches and tags
+        """
+        revision = formula['revision']
 
-            msg = "Fetching %s" % origin.url
-            if is_branch:
-                msg = msg + " to see if %s has changed" % formula['revision']
-            sys.stdout.write(msg)
-            origin.fetch(refspec="refs/tags/*:refs/tags/*")
-            origin.fetch()
-            print(" done")
+        sha = self._local_tag_sha(repo, revision)
+        if sha is not None:
+            self._count('local')
+            return sha
+
+        # plain or `git describe` sha - no point asking which ref it is
+        looks_like_sha = re.match(r'^(?:.*-g)?[0-9a-f]{7,40}$', revision)
+        if looks_like_sha:
+            sha = self._local_sha(repo, revision)
+            if sha is not None:
+                self._count('local')
+                return sha
+            remote_refs = {}
+        else:
+            remote_refs = self._ls_remote(repo)
+
+        # previous implementation always fetched tags and then everything else
+        self._count('baseline_round_trips', 2)
+
+        branch_sha = remote_refs.get('refs/heads/' + revision)
+        tag_sha = remote_refs.get('refs/tags/{}^{{}}'.format(revision), remote_refs.get('refs/tags/' + revision))
+        msg = "Fetching %s" % repo.remotes.origin.url
+
+        if branch_sha is not None:
+            if self._has_commit(repo, branch_sha):
+                # tip hasn't moved since we last fetched it
+                repo.git.update_ref('refs/remotes/origin/' + revision, branch_sha)
+                return branch_sha
+            self._fetch(repo)
+            sys.stdout.write(msg + " to see if %s has changed done\n" % revision)
+            sha = branch_sha if self._has_commit(repo, branch_sha) else None
+        elif tag_sha is not None:
+            self._fetch(repo, refspec='+refs/tags/{0}:refs/tags/{0}'.format(revision), want=tag_sha,
+                        depth=None if repo.head.is_valid() else 1)
+            sys.stdout.write(msg + " tag %s done\n" % revision)
+            sha = self._local_tag_sha(repo, revision)
+        else:
+            sha = None if looks_like_sha else self._local_sha(repo, revision)
+            if sha is None:
+                self._fetch(repo, want=revision if looks_like_sha else None)
+                sys.stdout.write(msg + " done\n")
+                sha = self._local_sha(repo, revision)
+
+        if sha is None:
+            raise RuntimeError("Could not find out what revision '{rev}' was for {url} (defined in {source}".format(
+                rev=revision,
+                url=formula['url'],
+                source=formula['source'],
+            ))
+        return sha
 
-            have_updated = True
+    def report_fetch_stats(self):
+        """
+        Print (and emit as 'shaker_fetch' metric) how many network round trips
+        resolving revisions took and saved
+        """
+        stats = dict(self.fetch_stats)
+        stats['round_trips'] = stats['ls_remotes'] + stats['fetches']
+        stats['round_trips_saved'] = stats['baseline_round_trips'] - stats['round_trips']
+        sys.stdout.write("Resolved revisions with {round_trips} network round trips "
+                         "({ls_remotes} ls-remote, {fetches} fetch, {local} local, {mirror_hits} from mirror), "
+                         "saved {round_trips_saved}\n".format(**stats))
+        metrics.emit('shaker_fetch', stats)
 
 
 @task
-def shaker():
+def shaker(pool_size=8, locked=False, mirror=False, snapshot=False, graph=False):
     """
     utility task to initiate Shaker in the most typical way
+    shaker:locked=1 installs formula-requirements.lock without resolving revisions
+    shaker:mirror=1 shares formula objects between projects in ~/.cache/cotton/formulas
+    shaker:snapshot=1 also exports vendor/_snapshots (see Shaker.export_snapshot)
+    shaker:graph=1 only prints the resolved formula dependency graph (graph=json for json)
     """
-    shaker_instance = Shaker(root_dir=os.path.dirname(env.real_fabfile))
-    shaker_instance.install_requirements()
+    shaker_instance = Shaker(root_dir=os.path.dirname(env.real_fabfile), pool_size=pool_size,
+                             use_mirror=is_true(mirror))
+    as_json = str(graph).lower() == 'json'
+    if as_json or is_true(graph):
+        _print_graph(shaker_instance.resolve_graph(), as_json=as_json)
+        return
+    shaker_instance.install_requirements(from_lock=is_true(locked))
+    if is_true(snapshot):
+        shaker_instance.export_snapshot()
+
+
+def _print_graph(graph, as_json):
+    if as_json:
+        print(json.dumps({
+            'formulas': dict(
+                (name, dict((key, formula[key]) for key in ('url', 'revision', 'sha', 'source')))
+                for name, formula in graph['formulas'].iteritems()),
+            'requires': graph['requires'],
+            'levels': graph['levels'],
+            'clashes': graph['clashes'],
+        }, indent=2, sort_keys=True))
+        return
+
+    for required_by, requires in graph['requires'].iteritems():
+        print(required_by)
+        for formula in requires:
+            print("  {name}=={revision} <{sha}>{status}".format(
+                name=formula['name'],
+                revision=formula['revision'],
+                sha=(formula['sha'] or '')[0:7],
+                status='' if formula['status'] == 'selected' else ' ' + formula['status']))
+    for number, level in enumerate(graph['levels']):
+        print("wave {}: {}".format(number + 1, ' '.join(level)))
+    for clash in graph['clashes']:
+        print(clash)
+
+
+def _print_versions(rows, headers, as_json):
+    if is_true(as_json):
+        print(json.dumps(rows, indent=2, sort_keys=True))
+    else:
+        from pptable import pptable
+        pptable(rows, headers=headers)
 
 
 @task
-def freeze():
+def freeze(pool_size=8, as_json=False):
     """
-    utility task to check current versions
+    utility task to show current versions of vendored formulas, freeze:as_json=1 prints json
     """
-    local('for d in vendor/formula-repos/*; do echo -n "$d "; git --git-dir=$d/.git describe --tags 2>/dev/null || git --git-dir=$d/.git rev-parse --short HEAD; done', shell='/bin/bash')
+    shaker_instance = Shaker(root_dir=os.path.dirname(env.real_fabfile), pool_size=pool_size)
+    rows = shaker_instance.formula_versions()
+    _print_versions(rows, ['formula', 'current', 'sha', 'locked', 'matches_lock'], as_json)
 
 
 @task
-def check():
+def check(pool_size=8, as_json=False):
     """
-    utility task to check if there are no new versions available
+    utility task to check if there are no new versions (tags) available, check:as_json=1 prints json
     """
-    local('for d in vendor/formula-repos/*; do (export GIT_DIR=$d/.git; git fetch --tags -q 2>/dev/null; echo -n "$d: "; latest_tag=$(git describe --tags $(git rev-list --tags --max-count=1 2>/dev/null) 2>/dev/null || echo "no tags"); current=$(git describe --tags 2>/dev/null || echo "no tags"); echo "\tlatest: $latest_tag  current: $current"); done', shell='/bin/bash')
+    shaker_instance = Shaker(root_dir=os.path.dirname(env.real_fabfile), pool_size=pool_size)
+    rows = shaker_instance.formula_versions(check_remote=True)
+    _print_versions(rows, ['formula', 'current', 'latest', 'outdated'], as_json)
@@ -1,5 +1,12 @@
 from __future__ import with_statement
 
+import os
+import re
+import time
+import atexit
+import shutil
+import subprocess
+import tempfile
 from os import getcwd, sep
 
 from fabric.network import needs_host, key_filenames, normalize
@@ -7,21 +14,105 @@ from fabric.operations import local
 from fabric.state import env, output
 from fabric.api import task
 
+from cotton import metrics
 
-def ssh_gateway(user, host):
+# directory with ssh control sockets of this run, see ssh_control_dir()
+_control_dir = None
+_control_dir_pid = None
 
-    if "gateway_user" in env and env.gateway_user:
-        user = env.gateway_user
 
-    if host.find('@') != -1:
-        remote_prefix = host
-    elif host.count(':') > 1:
-        # Square brackets are mandatory for IPv6 rsync address,
-        # even if port number is not specified
-        remote_prefix = "[%s@%s]" % (user, host)
+def _close_control_masters():
+    """
+    stops all ssh master connections started in this run (registered with atexit)
+    """
+    global _control_dir
+    if _control_dir is None or _control_dir_pid != os.getpid():
+        # forked workers leave the masters to the process that created them
+        return
+    with open(os.devnull, 'w') as devnull:
+        for name in os.listdir(_control_dir):
+            subprocess.call(['ssh', '-o', 'ControlPath={}'.format(os.path.join(_control_dir, name)), '-O', 'exit', 'cotton'],
+                            stdout=devnull, stderr=devnull)
+    shutil.rmtree(_control_dir, ignore_errors=True)
+    _control_dir = None
+
+
+def ssh_control_dir():
+    """
+    returns directory with ssh control sockets, created (with atexit cleanup)
+    on first call
+
+    call it before fabric forks @parallel workers - the workers then share
+    master connections (and the stdio gateway connection) and the parent
+    closes them, workers exit without running atexit handlers
+    """
+    global _control_dir, _control_dir_pid
+    if _control_dir is None:
+        # keep the path short - unix socket paths are limited to ~100 chars
+        _control_dir = tempfile.mkdtemp(prefix='cotton-ssh-', dir='/tmp')
+        _control_dir_pid = os.getpid()
+        atexit.register(_close_control_masters)
+    return _control_dir
+
+
+def ssh_control_opts(proxy_command=False, force=False):
+    """
+    returns ssh options that share one connection per host for the whole run
+    (ControlMaster/ControlPath/ControlPersist) or '' unless env.ssh_multiplex is set
+
+    use proxy_command=True for options of ssh executed as ProxyCommand
+    (ssh expands % tokens in ProxyCommand so they have to be escaped)
+    force=True enables it regardless of env.ssh_multiplex
+    """
+    if not force and ('ssh_multiplex' not in env or not env.ssh_multiplex):
+        return ''
+    control_path = os.path.join(ssh_control_dir(), '%r@%h:%p')
+    if proxy_command:
+        control_path = control_path.replace('%', '%%')
+    persist = env.ssh_control_persist if 'ssh_control_persist' in env and env.ssh_control_persist else 600
+    return '-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}'.format(control_path, persist)
+
+
+def ssh_proxy_opts(user, key_string='', ssh_opts=''):
+    """
+    returns ssh options that route connection through env.gateway or ''
+
+    env.gateway_transport selects how:
+    nc: ProxyCommand running netcat on the gateway (default)
+    stdio: ProxyCommand with ssh -W, no netcat needed, one gateway connection
+           is shared (ControlMaster) by all hosts for the whole run
+    jump: ssh -J (OpenSSH >= 7.3), gateway key has to be configured in ~/.ssh/config
+    """
+    if not env.gateway:
+        return ''
+
+    gw_user, gw_host, gw_port = normalize(env.gateway)
+    if '@' in env.gateway:
+        gw_user_host_string = ssh_host_string(gw_user, gw_host)
+    elif "gateway_user" in env and env.gateway_user:
+        gw_user_host_string = ssh_host_string(env.gateway_user, gw_host)
     else:
-        remote_prefix = "%s@%s" % (user, host)
-    return remote_prefix
+        gw_user_host_string = ssh_host_string(user, gw_host)
+
+    transport = env.gateway_transport if 'gateway_transport' in env and env.gateway_transport else 'nc'
+    if transport == 'jump':
+        return '-J {}:{}'.format(gw_user_host_string, gw_port)
+    elif transport == 'stdio':
+        return '-o "ProxyCommand ssh {key_string} {ssh_opts} {control_opts} -p {gw_port} -W %h:%p {gw_user_host_string}"'.format(
+            key_string=key_string,
+            ssh_opts=ssh_opts,
+            control_opts=ssh_control_opts(proxy_command=True, force=True),
+            gw_port=gw_port,
+            gw_user_host_string=gw_user_host_string)
+    elif transport == 'nc':
+        return '-o "ProxyCommand ssh {key_string} {ssh_opts} {control_opts} -p {gw_port} {gw_user_host_string} nc %h %p"'.format(
+            key_string=key_string,
+            ssh_opts=ssh_opts,
+            control_opts=ssh_control_opts(proxy_command=True),
+            gw_port=gw_port,
+            gw_user_host_string=gw_user_host_string)
+    else:
+        raise ValueError("Unknown gateway_transport '{}' - use one of: nc, stdio, jump".format(transport))
 
 
 def ssh_host_string(user, host):
@@ -44,7 +135,8 @@ def rsync_project(
     ssh_opts='',
     capture=False,
     upload=True,
-    default_opts='-pthrvz'
+    default_opts='-pthrvz',
+    stats=False
 ):
     """
     Synchronize a remote directory with the current project directory via rsync.
@@ -118,6 +210,10 @@ def rsync_project(
         The ``capture`` keyword argument.
     .. versionadded:: 1.8.0
         The ``default_opts`` keyword argument.
+
+    cotton: with ``stats=True`` rsync runs with ``--stats --itemize-changes``
+    and ``RsyncStats`` is returned (and emitted as 'rsync_project' metric)
+    instead of the output, which is then available as its ``output`` attribute.
     """
     # Turn single-string exclude into a one-item list for consistency
     if not hasattr(exclude, '__iter__'):
@@ -138,9 +234,9 @@ def rsync_project(
     # RSH
     rsh_string = ""
     rsh_parts = [key_string, port_string, ssh_opts]
-    proxy_string = ""
-    if env.gateway:
-        proxy_string = '-o "ProxyCommand ssh {} {} nc %h %p"'.format(" ".join(rsh_parts), ssh_gateway(user, env.gateway))
+    proxy_string = ssh_proxy_opts(user, key_string, ssh_opts)
+
+    rsh_parts += [ssh_control_opts()]
 
     rsh_parts += [proxy_string]
     if any(rsh_parts):
@@ -151,7 +247,7 @@ def rsync_project(
         'exclude': exclude_opts % exclusions,
         'rsh': rsh_string,
         'default': default_opts,
-        'extra': extra_opts,
+        'extra': "%s --stats --itemize-changes" % extra_opts if stats else extra_opts,
     }
     options = "%(delete)s%(exclude)s %(default)s %(extra)s %(rsh)s" % options_map
     # Get local directory
@@ -166,7 +262,111 @@ def rsync_project(
 
     if output.running:
         print("[%s] rsync_project: %s" % (env.host_string, cmd))
-    return local(cmd, capture=capture)
+    if not stats:
+        return local(cmd, capture=capture)
+
+    start_time = time.time()
+    result = local(cmd, capture=True)
+    if not capture and output.stdout and result:
+        print(result)
+    rsync_stats = RsyncStats.parse(result, elapsed=time.time() - start_time)
+    metrics.emit('rsync_project', dict(rsync_stats.as_dict(), host=env.host_string, remote_dir=remote_dir, upload=upload))
+    return rsync_stats
+
+
+class RsyncStats(object):
+    """
+    transfer statistics parsed from rsync --stats --itemize-changes output
+    """
+
+    _patterns = {
+        'files_scanned': r'Number of files: ([\d,]+)',
+        'files_transferred': r'Number of (?:regular )?files transferred: ([\d,]+)',
+        'files_deleted': r'Number of deleted files: ([\d,]+)',
+        'total_size': r'Total file size: ([\d,]+)',
+        'transferred_size': r'Total transferred file size: ([\d,]+)',
+        'literal_bytes': r'Literal data: ([\d,]+)',
+        'matched_bytes': r'Matched data: ([\d,]+)',
+        'bytes_sent': r'Total bytes sent: ([\d,]+)',
+        'bytes_received': r'Total bytes received: ([\d,]+)',
+        'file_list_generation_time': r'File list generation time: ([\d.]+)',
+        'file_list_transfer_time': r'File list transfer time: ([\d.]+)',
+        'speedup': r'speedup is ([\d,.]+)',
+    }
+
+    # i.e. '>f.st...... path', 'cd+++++++++ path/', '*deleting   path'
+    _itemize_re = re.compile(r'^([<>ch.*][fdLDS]\S{7,10}|\*deleting) +(.*)$')
+
+    def __init__(self, output='', elapsed=None, changes=None, **values):
+        self.output = output
+        self.elapsed = elapsed
+        self.changes = changes or []
+        for key in self._patterns:
+            setattr(self, key, values.get(key))
+
+    @classmethod
+    def parse(cls, output, elapsed=None):
+        values = {}
+        for key, pattern in cls._patterns.iteritems():
+            match = re.search(pattern, output)
+            if not match:
+                values[key] = None
+            elif key in ('file_list_generation_time', 'file_list_transfer_time', 'speedup'):
+                values[key] = float(match.group(1).replace(',', ''))
+            else:
+                values[key] = int(match.group(1).replace(',', ''))
+
+        changes = []
+        for line in output.splitlines():
+            match = cls._itemize_re.match(line)
+            if match:
+                changes.append((match.group(1), match.group(2)))
+        if values['files_deleted'] is None:
+            # rsync < 3.1 does not report deletions in --stats
+            values['files_deleted'] = len([1 for flags, _ in changes if flags == '*deleting'])
+        return cls(output=output, elapsed=elapsed, changes=changes, **values)
+
+    def as_dict(self):
+        """
+        returns all numbers (without output and itemized changes)
+        """
+        data = dict((key, getattr(self, key)) for key in self._patterns)
+        data['elapsed'] = self.elapsed
+        data['changed_paths'] = len(self.changes)
+        return data
+
+    def __str__(self):
+        return "%s/%s files transferred, %s deleted, %s literal + %s matched bytes, speedup %s" % (
+            self.files_transferred, self.files_scanned, self.files_deleted,
+            self.literal_bytes, self.matched_bytes, self.speedup)
+
+
+def rsync_project_many(hosts, remote_dir, local_dir=None, pool_size=5, **kwargs):
+    """
+    runs rsync_project to every host string in hosts, pool_size of them at a time
+
+    accepts the same arguments as rsync_project (except capture and stats)
+    returns dictionary host_string -> RsyncStats
+    """
+    from fabric.api import execute, parallel
+
+    kwargs['capture'] = True
+    kwargs['stats'] = True
+
+    @parallel(pool_size=int(pool_size))
+    def rsync_host():
+        return rsync_project(remote_dir, local_dir, **kwargs)
+
+    # before forking, so all workers share one connection per host and gateway
+    ssh_control_dir()
+    results = execute(rsync_host, hosts=hosts)
+
+    for host_string in hosts:
+        stats = results[host_string]
+        print("[%s] rsync_project: %s files, %s bytes sent in %.2fs" % (
+            host_string, stats.files_transferred, stats.bytes_sent, stats.elapsed))
+    return results
+
 
 @task
 @needs_host
@@ -193,25 +393,12 @@ def ssh(ssh_opts='', remote_cmd=None):
     port_string = "-p %s" % port
 
     # Proxy
-    proxy_string = ''
-    if env.gateway:
-        gw_user, gw_host, gw_port = normalize(env.gateway)
-        gw_port_string = "-p %s" % gw_port
-        if '@' in env.gateway:
-            gw_user_host_string = env.gateway
-        elif "gateway_user" in env and env.gateway_user:
-            gw_user_host_string = ssh_host_string(env.gateway_user, env.gateway)
-        else:
-            gw_user_host_string = ssh_host_string(user, env.gateway)
-        proxy_string = '-o "ProxyCommand ssh {key_string} {ssh_opts} {gw_port_string} {gw_user_host_string} nc %h %p"'.format(
-            key_string=key_string,
-            ssh_opts=ssh_opts,
-            gw_port_string=gw_port_string,
-            gw_user_host_string=gw_user_host_string)
+    proxy_string = ssh_proxy_opts(user, key_string, ssh_opts)
 
-    cmd = "ssh -A -o 'ServerAliveInterval 30' {key_string} {ssh_opts} {port_string} {user_host_string} {proxy_string}".format(
+    cmd = "ssh -A -o 'ServerAliveInterval 30' {key_string} {ssh_opts} {control_opts} {port_string} {user_host_string} {proxy_string}".format(
         key_string=key_string,
         ssh_opts=ssh_opts,
+        control_opts=ssh_control_opts(),
         port_string=port_string,
         user_host_string=ssh_host_string(user, host),
         proxy_string=proxy_string)
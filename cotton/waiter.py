@@ -0,0 +1,52 @@
+"""
+polling helper shared by provider drivers and tasks
+
+wait_for(lambda: instance.update() == 'running', timeout=600, progress=progress_dots)
+"""
+from __future__ import print_function
+import sys
+import time
+import random
+
+
+class WaitTimeout(RuntimeError):
+    pass
+
+
+def progress_dots(attempt, elapsed):
+    """
+    default progress callback - prints a dot per attempt
+    """
+    sys.stdout.write(".")
+    sys.stdout.flush()
+
+
+def wait_for(check, timeout=600, delay=1, max_delay=15, backoff=2, jitter=0.25, progress=None, description=None):
+    """
+    calls check() until it returns true value and returns that value
+
+    timeout: seconds after which WaitTimeout is raised (None waits forever)
+    delay: sleep after first failed attempt, multiplied by backoff after every attempt up to max_delay
+    jitter: up to this fraction of the delay is randomly added/subtracted so parallel waiters don't synchronise
+    progress: callback(attempt, elapsed) called after every failed attempt
+    """
+    start_time = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        result = check()
+        if result:
+            return result
+
+        elapsed = time.time() - start_time
+        if progress:
+            progress(attempt, elapsed)
+
+        sleep_time = delay * random.uniform(1 - jitter, 1 + jitter)
+        if timeout is not None:
+            if elapsed >= timeout:
+                raise WaitTimeout("Gave up waiting{} after {:.1f}s ({} attempts)".format(
+                    " for {}".format(description) if description else "", elapsed, attempt))
+            sleep_time = min(sleep_time, timeout - elapsed)
+        time.sleep(max(sleep_time, 0))
+        delay = min(delay * backoff, max_delay)
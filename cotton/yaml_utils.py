@@ -0,0 +1,77 @@
+"""
+single place for parsing yaml
+
+uses libyaml backed yaml.CSafeLoader when PyYAML was built with it
+and falls back to pure python yaml.SafeLoader otherwise
+"""
+from __future__ import print_function
+import os
+import timeit
+
+import yaml
+from fabric.api import task
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from cotton.colors import *
+
+
+def load(stream):
+    """
+    parses yaml document from string or file object
+    only standard yaml tags are accepted
+    """
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_file(path):
+    with open(path) as f:
+        return load(f)
+
+
+def _available_loaders():
+    loaders = [('Loader', yaml.Loader), ('SafeLoader', yaml.SafeLoader)]
+    if hasattr(yaml, 'CSafeLoader'):
+        loaders.append(('CSafeLoader', yaml.CSafeLoader))
+    return loaders
+
+
+@task
+def yaml_benchmark(paths=None, repeat=10):
+    """
+    compares yaml parse time of available loaders, i.e.: yaml_benchmark:paths=a.yaml;b.yaml
+    defaults to config files of current project
+    """
+    from pptable import pptable
+    from cotton.config import _get_config_files, _config_file_location
+
+    if paths:
+        paths = [os.path.abspath(path) for path in paths.split(';')]
+    else:
+        paths = [_config_file_location(os.path.expanduser(config_file['path'])) for config_file in _get_config_files()]
+    paths = [path for path in paths if os.path.isfile(path)]
+    repeat = int(repeat)
+
+    print(green("Using: {}".format(SafeLoader.__name__)))
+    loaders = _available_loaders()
+    rows = []
+    totals = dict((name, 0.0) for name, _ in loaders)
+    for path in paths:
+        with open(path) as f:
+            content = f.read()
+        row = {'file': path, 'size': len(content)}
+        for name, loader in loaders:
+            elapsed = min(timeit.repeat(lambda: yaml.load(content, Loader=loader), number=1, repeat=repeat))
+            row[name] = "{:.2f}ms".format(elapsed * 1000)
+            totals[name] += elapsed
+        rows.append(row)
+
+    total_row = {'file': 'total', 'size': sum(row['size'] for row in rows)}
+    for name, _ in loaders:
+        total_row[name] = "{:.2f}ms".format(totals[name] * 1000)
+    rows.append(total_row)
+
+    pptable(rows, headers=['file', 'size'] + [name for name, _ in loaders])